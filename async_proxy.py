@@ -0,0 +1,380 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2019-09-02 21:10
+# @File    : async_proxy.py
+
+import asyncio
+import socket
+from shared import DEFAULT_CHUNK_SIZE
+from proxy import DEFAULT_BACKLOG, DEFAULT_SNIFF_TIMEOUT
+from http_request import Request, RequestHeadTooLargeError, parse_request_head, parse_chunk_size, \
+    DEFAULT_MAX_HEAD_SIZE, DEFAULT_MAX_HEADERS
+from router import route_host
+from log import logger, access_logger
+from metrics import connections_accepted, connections_active, sniff_seconds, backend_connect_seconds, \
+    record_bytes, record_error, serve_stats
+
+
+async def read_request(reader: asyncio.StreamReader, max_head_size=DEFAULT_MAX_HEAD_SIZE,
+                       max_headers=DEFAULT_MAX_HEADERS)->(Request, bytes):
+    """
+    从stream中读取一个完整的请求头并解析, 每行可以用\r\n或者\n结尾
+    :param max_head_size: 请求头最大的字节数
+    :param max_headers: 请求头最多的个数
+    :return: request, 读取到的原始字节(用于回放给后端)
+    """
+    lines = []
+    size = 0
+    try:
+        while True:
+            line = await reader.readuntil(b"\n")
+            lines.append(line)
+            size += len(line)
+            if line == b"\r\n" or line == b"\n":
+                break
+            if size >= max_head_size:
+                raise RequestHeadTooLargeError("head exceeds %d bytes" % max_head_size)
+    except asyncio.LimitOverrunError as e:
+        # 超过了StreamReader的limit
+        raise RequestHeadTooLargeError(e)
+    head = b"".join(lines)
+    return parse_request_head(head, max_headers), head
+
+
+async def stream_copy(reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                      chunk_size=DEFAULT_CHUNK_SIZE, on_data=None)->int:
+    """
+    从reader中读取数据并写入writer,读到EOF后关闭writer的写端,返回一共拷贝的字节数
+    :param on_data: 每次读到数据时调用
+    """
+    copied = 0
+    try:
+        while True:
+            chunk = await reader.read(chunk_size)
+            if not chunk:
+                break
+            if on_data is not None:
+                on_data()
+            writer.write(chunk)
+            await writer.drain()
+            copied += len(chunk)
+    finally:
+        # 半关闭,让对端知道这个方向已经结束
+        if writer.can_write_eof() and not writer.is_closing():
+            try:
+                writer.write_eof()
+            except OSError:
+                pass
+    return copied
+
+
+async def copy_chunked_body(reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                            chunk_size=DEFAULT_CHUNK_SIZE, on_data=None)->int:
+    """
+    原样转发chunked编码的body(包括trailer),返回拷贝的字节数
+    :param on_data: 每次读到数据时调用
+    """
+    copied = 0
+    while True:
+        line = await reader.readuntil(b"\n")
+        if on_data is not None:
+            on_data()
+        writer.write(line)
+        copied += len(line)
+        size = parse_chunk_size(line)
+        if size == 0:
+            break
+        # chunk数据和结尾的\r\n
+        remain = size + 2
+        while remain > 0:
+            chunk = await reader.read(min(remain, chunk_size))
+            if not chunk:
+                raise asyncio.IncompleteReadError(b"", remain)
+            if on_data is not None:
+                on_data()
+            writer.write(chunk)
+            copied += len(chunk)
+            remain -= len(chunk)
+        await writer.drain()
+
+    # trailer,以空行结束
+    while True:
+        line = await reader.readuntil(b"\n")
+        if on_data is not None:
+            on_data()
+        writer.write(line)
+        copied += len(line)
+        if line.strip() == b"":
+            return copied
+
+
+def _close_result(future: asyncio.Future):
+    if future.cancelled() or future.exception() is not None:
+        return
+    s = future.result()
+    if s is not None:
+        s.close()
+
+
+class AsyncHandlerConn:
+    # 嗅探耗时指标的标签
+    sniff_kind = "http"
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, get_proxy_func):
+        self._reader = reader
+        self._writer = writer
+        self.get_proxy_func = get_proxy_func
+        # 超时(秒),None表示不限制,由AsyncProxy设置
+        self.sniff_timeout = None
+        self.connect_timeout = None
+        self.idle_timeout = None
+        # 请求头的限制,由AsyncProxy设置
+        self.max_head_size = DEFAULT_MAX_HEAD_SIZE
+        self.max_headers = DEFAULT_MAX_HEADERS
+        # 最近一次读到数据的时间(loop.time())
+        self._last_active = 0.0
+        self._idle_timer = None
+        self._p_writer = None
+
+        self.from_bytes, self.to_bytes = 0, 0
+
+    async def sniff(self)->(Request, bytes):
+        """
+        嗅探第一个请求
+        :return: request, 需要回放给后端的字节
+        """
+        return await read_request(self._reader, self.max_head_size, self.max_headers)
+
+    async def get_proxy(self, request: Request)->socket.socket:
+        # get_proxy同步版本会阻塞(connect),放到executor中执行,协程版本直接await
+        if asyncio.iscoroutinefunction(self.get_proxy_func):
+            return await self.get_proxy_func(request)
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(None, self.get_proxy_func, request)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # wait_for超时后executor中的连接还在进行,连接完成之后关闭
+            future.add_done_callback(_close_result)
+            raise
+
+    async def client_to_proxy(self, request: Request, prefix: bytes, writer: asyncio.StreamWriter)->int:
+        writer.write(prefix)
+        return len(prefix) + await stream_copy(self._reader, writer, on_data=self.touch)
+
+    def touch(self):
+        self._last_active = asyncio.get_running_loop().time()
+
+    def _check_idle(self):
+        """
+        事件循环的定时器,两个方向超过idle_timeout都没有数据时关闭连接
+        """
+        loop = asyncio.get_running_loop()
+        remain = self.idle_timeout - (loop.time() - self._last_active)
+        if remain > 0:
+            self._idle_timer = loop.call_later(remain, self._check_idle)
+            return
+        logger.info("relay idle for %ss, closing", self.idle_timeout)
+        self._writer.close()
+        if self._p_writer is not None:
+            self._p_writer.close()
+
+    async def run(self):
+        try:
+            with sniff_seconds.time(self.sniff_kind):
+                request, prefix = await asyncio.wait_for(self.sniff(), self.sniff_timeout)
+        except Exception as e:
+            record_error("sniff", e)
+            logger.info("read request failed cause: %s", e)
+            self._writer.close()
+            return
+
+        request.remote_addr = self._writer.get_extra_info("peername")
+        vhost = route_host(request)
+        proxy = None
+        try:
+            with backend_connect_seconds.time(vhost):
+                proxy = await asyncio.wait_for(self.get_proxy(request), self.connect_timeout)
+            if proxy is None:
+                raise Exception("get proxy is none")
+            p_reader, p_writer = await asyncio.open_connection(sock=proxy)
+        except Exception as e:
+            record_error("connect", e)
+            logger.warning("get proxy failed cause: %s", e)
+            if proxy is not None:
+                proxy.close()
+            self._writer.close()
+            return
+
+        from_addr = self._writer.get_extra_info("peername")
+        to_addr = p_writer.get_extra_info("peername")
+        self._p_writer = p_writer
+        if self.idle_timeout is not None:
+            self.touch()
+            self._idle_timer = asyncio.get_running_loop().call_later(self.idle_timeout, self._check_idle)
+        results = await asyncio.gather(self.client_to_proxy(request, prefix, p_writer),
+                                       stream_copy(p_reader, self._writer, on_data=self.touch),
+                                       return_exceptions=True)
+        if self._idle_timer is not None:
+            self._idle_timer.cancel()
+        for res in results:
+            if isinstance(res, Exception):
+                record_error("relay", res)
+                logger.info("relay broken cause: %s", res)
+        self.from_bytes = results[0] if isinstance(results[0], int) else 0
+        self.to_bytes = results[1] if isinstance(results[1], int) else 0
+        record_bytes(vhost, self.from_bytes, self.to_bytes)
+
+        # close conn
+        self._writer.close()
+        p_writer.close()
+        access_logger.info("%d(from), %d(to) bytes copied between %s and %s(%s) before break",
+                           self.from_bytes, self.to_bytes, from_addr, to_addr, vhost)
+
+
+class AsyncHandleCrackConn(AsyncHandlerConn):
+    sniff_kind = "crack"
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, get_proxy_func,
+                 request_handler=None):
+        AsyncHandlerConn.__init__(self, reader, writer, get_proxy_func)
+        self.request_handler = request_handler
+
+    def _handle(self, request: Request)->bytes:
+        body_len = request.content_length
+        if self.request_handler:
+            request = self.request_handler(request)
+            request.content_length = body_len
+        return request.to_bytes()
+
+    async def client_to_proxy(self, request: Request, prefix: bytes, writer: asyncio.StreamWriter)->int:
+        """
+        与CrackConn一致: 不断读取完整的request,用request_handler处理后写入后端,body分段转发
+        """
+        copied = 0
+        try:
+            while True:
+                body_len = request.content_length
+                head = self._handle(request)
+                writer.write(head)
+                copied += len(head)
+                if request.chunked:
+                    copied += await copy_chunked_body(self._reader, writer, on_data=self.touch)
+                while body_len > 0:
+                    chunk = await self._reader.read(min(body_len, DEFAULT_CHUNK_SIZE))
+                    if not chunk:
+                        return copied
+                    self.touch()
+                    writer.write(chunk)
+                    copied += len(chunk)
+                    body_len -= len(chunk)
+                await writer.drain()
+                try:
+                    request, _ = await read_request(self._reader, self.max_head_size, self.max_headers)
+                except asyncio.IncompleteReadError:
+                    return copied
+                self.touch()
+        finally:
+            if writer.can_write_eof() and not writer.is_closing():
+                try:
+                    writer.write_eof()
+                except OSError:
+                    pass
+
+
+class AsyncProxy:
+    def __init__(self, get_proxy, server_host="127.0.0.1", server_port=9999, backlog=DEFAULT_BACKLOG,
+                 max_head_size=DEFAULT_MAX_HEAD_SIZE, max_headers=DEFAULT_MAX_HEADERS):
+        """
+        单个事件循环处理所有连接的Proxy
+        :param get_proxy: 获取proxy方法,第一个参数默认为request,可以是普通函数或协程函数
+        :param server_host: 服务监听地址
+        :param server_port: 服务监听端口
+        :param max_head_size: 请求头最大的字节数
+        :param max_headers: 请求头最多的个数
+        """
+        self.get_proxy = get_proxy
+        self.backlog = backlog
+        self.max_head_size = max_head_size
+        self.max_headers = max_headers
+        self.server_addr = (server_host, server_port)
+        # 多个进程监听同一个地址时设置
+        self.reuse_port = False
+        # 读取第一个请求/连接后端/转发空闲的超时(秒),由事件循环的定时器实现
+        self.sniff_timeout = DEFAULT_SNIFF_TIMEOUT
+        self.connect_timeout = None
+        self.idle_timeout = None
+        self.accepted = 0
+        self.active = 0
+        # 设置了则在这个地址上提供/metrics
+        self.stats_addr: (str, int) = None
+        # 设置了ConfigManager则每个连接使用accept时的配置(路由/改写规则/超时)
+        self.config = None
+        self._listen = "%s:%d" % self.server_addr
+        self._server = None
+
+    def _handler_conn(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        return AsyncHandlerConn(reader, writer, self.get_proxy)
+
+    async def _accept(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        logger.debug("accept connection from %s", writer.get_extra_info("peername"))
+        self.accepted += 1
+        self.active += 1
+        connections_accepted.inc(self._listen)
+        connections_active.inc(self._listen)
+        handler = self._handler_conn(reader, writer)
+        handler.sniff_timeout = self.sniff_timeout
+        handler.connect_timeout = self.connect_timeout
+        handler.idle_timeout = self.idle_timeout
+        handler.max_head_size = self.max_head_size
+        handler.max_headers = self.max_headers
+        config, snapshot = self.config, None
+        if config is not None:
+            snapshot = config.acquire()
+            snapshot.bind(handler)
+        try:
+            await handler.run()
+        finally:
+            self.active -= 1
+            connections_active.dec(self._listen)
+            if snapshot is not None:
+                config.release(snapshot)
+
+    def stats(self)->dict:
+        return {
+            "accepted": self.accepted,
+            "active": self.active,
+        }
+
+    async def listen_and_accept(self):
+        # readuntil一行最多读取limit字节,不能小于请求头的限制
+        self._server = await asyncio.start_server(self._accept, self.server_addr[0], self.server_addr[1],
+                                                  backlog=self.backlog, reuse_address=True,
+                                                  reuse_port=self.reuse_port or None,
+                                                  limit=max(self.max_head_size, DEFAULT_MAX_HEAD_SIZE))
+        logger.info("server listen at: %s: %d", self.server_addr[0], self.server_addr[1])
+        if self.stats_addr is not None:
+            try:
+                serve_stats(*self.stats_addr)
+            except OSError as e:
+                # 没有/metrics也继续转发
+                logger.error("serve stats at %s failed cause: %s", self.stats_addr, e)
+        if self.config is not None:
+            self.config.start()
+        try:
+            async with self._server:
+                await self._server.serve_forever()
+        except Exception as e:
+            logger.error("server failed with %s , closing", e)
+
+    def start(self):
+        asyncio.run(self.listen_and_accept())
+
+
+class AsyncCrackProxy(AsyncProxy):
+    def __init__(self, get_proxy, server_host="127.0.0.1", server_port=9999, backlog=DEFAULT_BACKLOG, request_handler=None,
+                 max_head_size=DEFAULT_MAX_HEAD_SIZE, max_headers=DEFAULT_MAX_HEADERS):
+        AsyncProxy.__init__(self, get_proxy, server_host, server_port, backlog, max_head_size, max_headers)
+        self.request_handler = request_handler
+
+    def _handler_conn(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        return AsyncHandleCrackConn(reader, writer, self.get_proxy, self.request_handler)
@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2019-10-03 16:20
+# @File    : balancer.py
+
+import time
+import bisect
+import socket
+import hashlib
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from log import logger
+from metrics import registry
+
+
+# 负载均衡方式
+BALANCE_ROUND_ROBIN = "round_robin"
+BALANCE_LEAST_CONN = "least_conn"
+# 一致性hash, 按客户端ip或者host
+BALANCE_HASH_IP = "hash_ip"
+BALANCE_HASH_HOST = "hash_host"
+
+# 一致性hash中每个后端的虚拟节点数
+HASH_REPLICAS = 100
+
+# 多个worker时只有所有worker都认为可用才是1
+backend_up = registry.gauge("vhost_backend_up", "1 if the backend is healthy and not ejected.", ("backend",),
+                            merge="min")
+
+
+def _hash(key: str)->int:
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[: 8], "big")
+
+
+class Backend:
+    def __init__(self, addr: (str, int), max_fails=1, eject_time=10.0):
+        """
+        一个后端地址及其状态
+        :param max_fails: 连续连接失败多少次之后摘除
+        :param eject_time: 摘除的时间(秒),之后重新参与负载均衡
+        """
+        self.addr = addr
+        self.name = "%s:%d" % addr
+        self.max_fails = max_fails
+        self.eject_time = eject_time
+        # 主动健康检查的结果
+        self.healthy = True
+        # 连续的连接失败次数(转发时)
+        self.fails = 0
+        self.ejected_until = 0.0
+        # 正在使用的连接数
+        self.active = 0
+        # 健康检查连续成功/失败的次数
+        self.check_ok = 0
+        self.check_fail = 0
+        self._lock = threading.Lock()
+        backend_up.set(self.name, value=1)
+
+    def available(self, now: float = None)->bool:
+        if not self.healthy:
+            return False
+        return (now if now is not None else time.monotonic()) >= self.ejected_until
+
+    def update_gauge(self):
+        backend_up.set(self.name, value=1 if self.available() else 0)
+
+    def on_success(self):
+        self.fails = 0
+
+    def on_failure(self, e: Exception):
+        """
+        被动摘除: 连续失败max_fails次之后eject_time秒内不再使用
+        """
+        with self._lock:
+            self.fails += 1
+            if self.fails < self.max_fails:
+                return
+            self.fails = 0
+            self.ejected_until = time.monotonic() + self.eject_time
+        logger.warning("backend %s ejected for %ss cause: %s", self.name, self.eject_time, e)
+        self.update_gauge()
+
+    def set_healthy(self, healthy: bool):
+        if healthy == self.healthy:
+            return
+        self.healthy = healthy
+        if healthy:
+            # 恢复之后不再受之前的被动摘除影响
+            self.ejected_until = 0.0
+        logger.warning("backend %s is %s", self.name, "up" if healthy else "down")
+        self.update_gauge()
+
+    def acquire(self, s: socket.socket)->socket.socket:
+        """
+        记录一个正在使用的连接
+        :return: 代替s使用的BackendSocket, close时减少active
+        """
+        with self._lock:
+            self.active += 1
+        timeout = s.gettimeout()
+        bs = BackendSocket(s.family, s.type, s.proto, fileno=s.detach())
+        bs.settimeout(timeout)
+        bs.backend = self
+        return bs
+
+    def release(self):
+        with self._lock:
+            self.active -= 1
+
+    def __repr__(self):
+        return "Backend(%s)" % self.name
+
+
+class BackendSocket(socket.socket):
+    """
+    BackendPool.connect返回的socket, 第一次close时释放所属Backend的计数
+    """
+    __slots__ = ("backend",)
+
+    def close(self):
+        backend, self.backend = getattr(self, "backend", None), None
+        if backend is not None:
+            backend.release()
+        socket.socket.close(self)
+
+
+class RoundRobin:
+    def __init__(self, backends: list):
+        self.backends = backends
+        self._counter = itertools.count()
+
+    def order(self, key=None)->list:
+        """
+        尝试连接的顺序,只在可用的后端之间轮询
+        """
+        now = time.monotonic()
+        backends = [b for b in self.backends if b.available(now)] or self.backends
+        start = next(self._counter) % len(backends)
+        return backends[start:] + backends[: start]
+
+
+class LeastConn(RoundRobin):
+    def order(self, key=None)->list:
+        # 连接数相同的按轮询的顺序
+        return sorted(RoundRobin.order(self), key=lambda b: b.active)
+
+
+class ConsistentHash:
+    def __init__(self, backends: list, replicas=HASH_REPLICAS):
+        """
+        同一个key总是先选择同一个后端,后端增减时只影响一部分key
+        """
+        self.backends = backends
+        ring = []
+        for i, backend in enumerate(backends):
+            for r in range(replicas):
+                ring.append((_hash("%s#%d" % (backend.name, r)), i))
+        ring.sort()
+        self._hashes = [h for h, _ in ring]
+        self._indexes = [i for _, i in ring]
+
+    def order(self, key=None)->list:
+        if key is None:
+            return list(self.backends)
+        n = len(self.backends)
+        start = bisect.bisect(self._hashes, _hash(key))
+        seen, order = set(), []
+        for j in range(len(self._indexes)):
+            i = self._indexes[(start + j) % len(self._indexes)]
+            if i not in seen:
+                seen.add(i)
+                order.append(self.backends[i])
+                if len(order) == n:
+                    break
+        return order
+
+
+BALANCERS = {
+    BALANCE_ROUND_ROBIN: RoundRobin,
+    BALANCE_LEAST_CONN: LeastConn,
+    BALANCE_HASH_IP: ConsistentHash,
+    BALANCE_HASH_HOST: ConsistentHash,
+}
+
+
+def new_balancer(balance: str, backends: list):
+    cls = BALANCERS.get(balance)
+    if cls is None:
+        raise ValueError("balance must be (%s)" % ",".join(BALANCERS))
+    return cls(backends)
+
+
+class HealthChecker:
+    def __init__(self, interval=5.0, timeout=1.0, rise=2, fall=3, workers=16):
+        """
+        后台线程定期对所有后端做TCP连接检查
+        :param interval: 检查间隔(秒)
+        :param timeout: 连接超时(秒)
+        :param rise: 连续成功多少次认为恢复
+        :param fall: 连续失败多少次认为不可用
+        :param workers: 同时检查的后端数
+        """
+        self.interval = interval
+        self.timeout = timeout
+        self.rise = rise
+        self.fall = fall
+        self.workers = workers
+        self._backends = dict()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._checker = None
+        self._executor = None
+
+    def add(self, backends: list):
+        with self._lock:
+            for backend in backends:
+                self._backends[id(backend)] = backend
+
+    def remove(self, backends: list):
+        with self._lock:
+            for backend in backends:
+                self._backends.pop(id(backend), None)
+
+    def check(self, backend: Backend):
+        try:
+            s = socket.create_connection(backend.addr, timeout=self.timeout)
+            s.close()
+        except OSError:
+            backend.check_ok = 0
+            backend.check_fail += 1
+            if backend.check_fail >= self.fall:
+                backend.set_healthy(False)
+            return
+        backend.check_fail = 0
+        backend.check_ok += 1
+        if backend.check_ok >= self.rise:
+            backend.set_healthy(True)
+        # 被动摘除到期之后更新指标
+        backend.update_gauge()
+
+    def check_all(self):
+        with self._lock:
+            backends = list(self._backends.values())
+        if self._executor is None:
+            for backend in backends:
+                self.check(backend)
+            return
+        list(self._executor.map(self.check, backends))
+
+    def _check_loop(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.check_all()
+            except Exception as e:
+                logger.error("health check failed cause: %s", e)
+
+    def start(self):
+        if self._checker is not None:
+            return
+        self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        self._checker = threading.Thread(target=self._check_loop)
+        self._checker.setDaemon(True)
+        self._checker.start()
+
+    def close(self):
+        self._stopped.set()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
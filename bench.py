@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2019-09-30 22:05
+# @File    : bench.py
+
+"""
+热点路径的基准测试,后端都是本机loopback上的socket
+
+python bench.py                       # 跑所有基准,结果以json输出到stdout
+python bench.py -o new.json -c old.json  # 保存结果并和之前的结果比较
+python bench.py parse proxy --concurrency 32
+"""
+
+import ssl
+import sys
+import json
+import time
+import socket
+import logging
+import argparse
+import platform
+import threading
+import subprocess
+import log
+from shared import Buffer, Conn, io_copy, DEFAULT_CHUNK_SIZE
+from http_request import RequestReader, Request
+from tls import read_client_hello
+from crack import CrackConn
+from proxy import Proxy, DEFAULT_BACKLOG
+
+
+REQUEST_HEAD = (b"GET /index.html?a=1&b=2 HTTP/1.1\r\n"
+                b"Host: www.example.com\r\n"
+                b"User-Agent: Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36\r\n"
+                b"Accept: text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8\r\n"
+                b"Accept-Encoding: gzip, deflate\r\n"
+                b"Accept-Language: en-US,en;q=0.9\r\n"
+                b"Connection: keep-alive\r\n\r\n")
+
+RESPONSE = b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\nConnection: close\r\n\r\nok"
+
+
+def _percentile(sorted_values: list, p: float)->float:
+    if not sorted_values:
+        return 0.0
+    k = min(len(sorted_values) - 1, int(round(p / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[k]
+
+
+def _free_port()->int:
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def _serve(handle)->(str, int):
+    """
+    在后台线程中accept,每个连接一个线程调用handle(conn)
+    """
+    srv = socket.socket()
+    srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    srv.bind(("127.0.0.1", 0))
+    srv.listen(DEFAULT_BACKLOG)
+
+    def loop():
+        while True:
+            c, _ = srv.accept()
+            t = threading.Thread(target=handle, args=(c,))
+            t.daemon = True
+            t.start()
+
+    t = threading.Thread(target=loop)
+    t.daemon = True
+    t.start()
+    return srv.getsockname()
+
+
+def _http_backend(c: socket.socket):
+    """
+    读取请求头后返回一个固定的响应并关闭连接
+    """
+    try:
+        data = b""
+        while b"\r\n\r\n" not in data:
+            chunk = c.recv(DEFAULT_CHUNK_SIZE)
+            if not chunk:
+                return
+            data += chunk
+        c.sendall(RESPONSE)
+    finally:
+        c.close()
+
+
+def _client_hello(server_name: str)->bytes:
+    """
+    用ssl的MemoryBIO生成一个真实的ClientHello
+    """
+    ctx = ssl.create_default_context()
+    incoming, outgoing = ssl.MemoryBIO(), ssl.MemoryBIO()
+    obj = ctx.wrap_bio(incoming, outgoing, server_hostname=server_name)
+    try:
+        obj.do_handshake()
+    except ssl.SSLWantReadError:
+        pass
+    return outgoing.read()
+
+
+def _drain(s: socket.socket, chunk_size=DEFAULT_CHUNK_SIZE):
+    buff = bytearray(chunk_size)
+    total = 0
+    while True:
+        n = s.recv_into(buff)
+        if n == 0:
+            return total
+        total += n
+
+
+def bench_parse_request(n: int)->dict:
+    data = REQUEST_HEAD * n
+    reader = RequestReader(Buffer(data))
+    start = time.perf_counter()
+    for _ in range(n):
+        reader.read_request()
+    elapsed = time.perf_counter() - start
+    reader.release()
+    return {"requests": n, "seconds": elapsed, "requests_per_sec": n / elapsed, "us_per_request": elapsed / n * 1e6}
+
+
+def bench_client_hello(n: int)->dict:
+    hello = _client_hello("www.example.com")
+    start = time.perf_counter()
+    for _ in range(n):
+        client_hello = read_client_hello(Buffer(hello))
+    elapsed = time.perf_counter() - start
+    assert client_hello.server_name == "www.example.com"
+    return {"hellos": n, "bytes": len(hello), "seconds": elapsed, "hellos_per_sec": n / elapsed,
+            "us_per_hello": elapsed / n * 1e6}
+
+
+def bench_crack(n: int, body_size: int, chunk_size: int)->dict:
+    """
+    CrackConn读取并改写n个带body的请求的吞吐
+    """
+    def rewrite(req: Request)->Request:
+        req.uri = "/rewritten"
+        return req
+
+    head = b"POST /upload HTTP/1.1\r\nHost: www.example.com\r\nContent-Length: %d\r\n\r\n" % body_size
+    request = head + b"x" * body_size
+    client, server = socket.socketpair()
+
+    def send():
+        for _ in range(n):
+            client.sendall(request)
+        client.shutdown(socket.SHUT_WR)
+
+    t = threading.Thread(target=send)
+    t.daemon = True
+    start = time.perf_counter()
+    t.start()
+    conn = CrackConn(server, rewrite, chunk_size)
+    buff = bytearray(chunk_size)
+    total = 0
+    while True:
+        got = conn.recv_into(buff)
+        if got == 0:
+            break
+        total += got
+    elapsed = time.perf_counter() - start
+    t.join()
+    conn.close()
+    client.close()
+    return {"requests": n, "body_size": body_size, "bytes_out": total, "seconds": elapsed,
+            "requests_per_sec": n / elapsed, "mb_per_sec": n * len(request) / elapsed / 1e6}
+
+
+def bench_io_copy(total_mb: int, chunk_size: int)->dict:
+    """
+    src -> io_copy -> dst 的吞吐,两边都是loopback tcp连接
+    """
+    ready = threading.Event()
+
+    def sink(c: socket.socket):
+        ready.set()
+        _drain(c, chunk_size)
+        c.close()
+
+    sink_addr = _serve(sink)
+    src_srv = socket.socket()
+    src_srv.bind(("127.0.0.1", 0))
+    src_srv.listen(1)
+    feeder = socket.create_connection(src_srv.getsockname())
+    src, _ = src_srv.accept()
+    src_srv.close()
+    dst = socket.create_connection(sink_addr)
+    ready.wait()
+
+    total = total_mb * 1024 * 1024
+    payload = b"x" * (1024 * 1024)
+
+    def feed():
+        for _ in range(total_mb):
+            feeder.sendall(payload)
+        feeder.shutdown(socket.SHUT_WR)
+
+    t = threading.Thread(target=feed)
+    t.daemon = True
+    start = time.perf_counter()
+    t.start()
+    src_conn, dst_conn = Conn(src), Conn(dst)
+    copied = io_copy(src_conn, dst_conn, chunk_size=chunk_size)
+    dst_conn.shutdown(socket.SHUT_WR)
+    elapsed = time.perf_counter() - start
+    t.join()
+    src_conn.close()
+    dst_conn.close()
+    feeder.close()
+    assert copied == total, (copied, total)
+    return {"bytes": copied, "seconds": elapsed, "mb_per_sec": copied / elapsed / 1e6}
+
+
+def bench_proxy(requests: int, concurrency: int)->dict:
+    """
+    端到端: 每个请求新建连接经过Proxy转发到后端,测量rps和延迟分布
+    """
+    backend = _serve(_http_backend)
+
+    def get_proxy(_):
+        return socket.create_connection(backend)
+
+    port = _free_port()
+    proxy = Proxy(get_proxy, "127.0.0.1", port, backlog=max(DEFAULT_BACKLOG, concurrency * 2))
+    t = threading.Thread(target=proxy.start)
+    t.daemon = True
+    t.start()
+    deadline = time.monotonic() + 5
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            break
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.01)
+
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    counter = iter(range(requests))
+
+    def client():
+        local = []
+        while True:
+            with lock:
+                if next(counter, None) is None:
+                    break
+            begin = time.perf_counter()
+            try:
+                c = socket.create_connection(("127.0.0.1", port))
+                c.sendall(REQUEST_HEAD)
+                _drain(c)
+                c.close()
+                local.append(time.perf_counter() - begin)
+            except OSError:
+                with lock:
+                    errors[0] += 1
+        with lock:
+            latencies.extend(local)
+
+    clients = [threading.Thread(target=client) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for c in clients:
+        c.start()
+    for c in clients:
+        c.join()
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {"requests": requests, "concurrency": concurrency, "errors": errors[0], "seconds": elapsed,
+            "requests_per_sec": len(latencies) / elapsed,
+            "p50_ms": _percentile(latencies, 50) * 1e3, "p99_ms": _percentile(latencies, 99) * 1e3}
+
+
+BENCHES = ("parse", "client_hello", "crack", "io_copy", "proxy")
+
+
+def run(names, args)->dict:
+    results = dict()
+    for name in names:
+        if name == "parse":
+            results[name] = bench_parse_request(args.requests * 10)
+        elif name == "client_hello":
+            results[name] = bench_client_hello(args.requests * 10)
+        elif name == "crack":
+            results[name] = bench_crack(args.requests, args.body_size, args.chunk_size)
+        elif name == "io_copy":
+            results[name] = bench_io_copy(args.megabytes, args.chunk_size)
+        elif name == "proxy":
+            results[name] = bench_proxy(args.requests, args.concurrency)
+        print("%s: %s" % (name, json.dumps(results[name])), file=sys.stderr)
+    return results
+
+
+def _revision()->str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def compare(old: dict, new: dict)->list:
+    """
+    :return: [(基准, 指标, 旧值, 新值, 变化比例)] 只比较都有的数值指标
+    """
+    rows = []
+    for name, metrics in new.get("results", {}).items():
+        old_metrics = old.get("results", {}).get(name, {})
+        for k, v in metrics.items():
+            o = old_metrics.get(k)
+            if not isinstance(v, (int, float)) or not isinstance(o, (int, float)) or o == 0:
+                continue
+            rows.append((name, k, o, v, (v - o) / o))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="benchmark sniffing, parsing and relaying")
+    parser.add_argument("benches", nargs="*", metavar="BENCH", help="any of %s, default all" % ",".join(BENCHES))
+    parser.add_argument("--requests", type=int, default=2000, help="requests per bench")
+    parser.add_argument("--concurrency", type=int, default=16, help="clients of the proxy bench")
+    parser.add_argument("--body-size", type=int, default=4096, help="request body size of the crack bench")
+    parser.add_argument("--megabytes", type=int, default=256, help="bytes copied by the io_copy bench")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument("-o", "--output", help="write json results to this file instead of stdout")
+    parser.add_argument("-c", "--compare", help="json results of a previous run to compare with")
+    args = parser.parse_args(argv)
+    for name in args.benches:
+        if name not in BENCHES:
+            parser.error("unknown bench: %s" % name)
+
+    # 只保留错误日志,避免访问日志影响结果
+    log.setup(level=logging.ERROR, access_level=logging.ERROR)
+
+    report = {
+        "revision": _revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "params": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+        "results": run(args.benches or BENCHES, args),
+    }
+
+    data = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(data + "\n")
+    else:
+        print(data)
+
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        print("compared with %s:" % (old.get("revision") or args.compare), file=sys.stderr)
+        for name, k, o, v, change in compare(old, report):
+            print("  %-14s %-18s %12.3f -> %12.3f  %+.1f%%" % (name, k, o, v, change * 100), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
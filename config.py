@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2019-10-07 10:45
+# @File    : config.py
+
+import os
+import json
+import signal
+import threading
+from collections import namedtuple
+from log import logger
+from metrics import registry
+from router import VhostRouter, BackendPool, DEFAULT_CONNECT_TIMEOUT
+from rewrite import RuleSet
+from balancer import HealthChecker, BALANCE_ROUND_ROBIN
+from upstream import UpstreamPools
+
+
+# 检查配置文件是否修改的间隔(秒)
+DEFAULT_WATCH_INTERVAL = 1.0
+
+LIMIT_KEYS = ("connect_timeout", "idle_timeout", "sniff_timeout")
+ROUTE_KEYS = ("host", "backends", "balance", "max_fails", "eject_time")
+
+config_reloads = registry.counter("vhost_config_reloads_total", "Config reloads, by result.", ("result",))
+# 多个worker时取最小值,可以看出是否有worker还在用旧的配置
+config_version = registry.gauge("vhost_config_version", "Version of the config snapshot in use.", merge="min")
+
+
+class Snapshot(namedtuple("Snapshot", ("version", "router", "rewrite", "limits"))):
+    """
+    一次加载的配置,创建之后不再修改
+    新连接accept时绑定当前的快照,之后一直使用这个快照直到连接结束
+    """
+    __slots__ = ()
+
+    def bind(self, handler):
+        """
+        把快照设置到HandlerConn/AsyncHandlerConn, 配置中没有的项保持Proxy的设置
+        """
+        handler.get_proxy_func = self.router
+        if self.rewrite is not None and hasattr(handler, "request_handler"):
+            handler.request_handler = self.rewrite
+        for k in ("idle_timeout", "sniff_timeout", "connect_timeout"):
+            if k in self.limits and hasattr(handler, k):
+                setattr(handler, k, self.limits[k])
+        return handler
+
+    def backends(self)->list:
+        return [backend for pool in self.router.pools() for backend in pool.backends]
+
+
+def _check_keys(kind: str, d: dict, keys: tuple):
+    unknown = set(d) - set(keys)
+    if unknown:
+        raise ValueError("unknown %s keys: %s" % (kind, ",".join(sorted(unknown))))
+
+
+def build_snapshot(conf: dict, upstream: UpstreamPools = None, version=0)->Snapshot:
+    """
+    {
+        "routes": [{"host": "*.example.com", "backends": ["127.0.0.1:8080"], "balance": "round_robin",
+                    "max_fails": 1, "eject_time": 10}],
+        "default": ["127.0.0.1:8000"],
+        "rewrite": [{"path_prefix": "/api", "set_path": "/v1"}],
+        "limits": {"connect_timeout": 5, "idle_timeout": 60, "sniff_timeout": 10}
+    }
+    除了routes中的host和backends都可以省略
+    """
+    _check_keys("config", conf, ("routes", "default", "rewrite", "limits"))
+    limits = dict(conf.get("limits") or {})
+    _check_keys("limits", limits, LIMIT_KEYS)
+    connect_timeout = limits.get("connect_timeout", DEFAULT_CONNECT_TIMEOUT)
+    routes = conf.get("routes") or []
+    # 创建BackendPool之前检查完, BackendPool会attach到upstream
+    hosts = {"*"} if conf.get("default") is not None else set()
+    for route in routes:
+        _check_keys("route", route, ROUTE_KEYS)
+        for key in ("host", "backends"):
+            if key not in route:
+                raise ValueError("route needs %s" % key)
+        # 重复的host会替换之前的BackendPool
+        host = route["host"].strip().lower().rstrip(".")
+        if host in hosts:
+            raise ValueError("duplicate route host: %s" % route["host"])
+        hosts.add(host)
+
+    rewrite = conf.get("rewrite")
+    if rewrite is not None:
+        rewrite = RuleSet(rewrite)
+
+    router = VhostRouter(conf.get("default"), upstream, connect_timeout=connect_timeout)
+    try:
+        for route in routes:
+            pool = BackendPool(route["backends"], connect_timeout, upstream,
+                               route.get("balance", BALANCE_ROUND_ROBIN), route.get("max_fails", 1),
+                               route.get("eject_time", 10.0))
+            router.add(route["host"], pool)
+    except Exception:
+        # 地址/balance不合法等, 已经创建的BackendPool不再使用
+        router.close()
+        raise
+    return Snapshot(version, router, rewrite, limits)
+
+
+class ConfigManager:
+    def __init__(self, path: str, upstream: UpstreamPools = None, health_checker: HealthChecker = None,
+                 watch_interval=DEFAULT_WATCH_INTERVAL):
+        """
+        从json文件加载路由/后端/改写规则/超时,收到SIGHUP或文件修改时重新加载
+        加载成功后整体替换snapshot,加载失败保留之前的snapshot
+        设置为Proxy.config后每个新连接使用accept时的snapshot,已有的连接不受影响
+        旧snapshot的连接都结束之后关闭它的BackendPool
+        :param path: 配置文件, 格式见build_snapshot
+        :param upstream: 所有snapshot的后端共用的连接池
+        :param health_checker: 加载后检查新的后端,不再检查旧的后端
+        :param watch_interval: 检查文件修改的间隔(秒), None表示只在收到SIGHUP时重新加载
+        """
+        self.path = path
+        self.upstream = upstream
+        self.health_checker = health_checker
+        self.watch_interval = watch_interval
+        self.snapshot: Snapshot = None
+        self._stat = None
+        self._lock = threading.Lock()
+        # version -> 使用这个snapshot的连接数
+        self._users = dict()
+        # 已经被替换但还有连接在使用的snapshot
+        self._retired = dict()
+        self._users_lock = threading.Lock()
+        self._reload_event = threading.Event()
+        self._stopped = threading.Event()
+        self._watcher = None
+        self.load()
+
+    def _file_stat(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return st.st_ino, st.st_size, st.st_mtime_ns
+
+    def load(self)->Snapshot:
+        """
+        加载配置文件并替换当前的snapshot, 出错时抛出异常
+        """
+        with self._lock:
+            # 读取之前记录,读取过程中文件被修改会再加载一次
+            self._stat = self._file_stat()
+            with open(self.path) as f:
+                conf = json.load(f)
+            old = self.snapshot
+            snapshot = build_snapshot(conf, self.upstream, old.version + 1 if old is not None else 1)
+            if old is not None:
+                self._inherit(old, snapshot)
+            if self.health_checker is not None:
+                self.health_checker.add(snapshot.backends())
+                if old is not None:
+                    self.health_checker.remove(old.backends())
+            with self._users_lock:
+                self.snapshot = snapshot
+                if old is not None and old.version in self._users:
+                    self._retired[old.version] = old
+                    old = None
+            if old is not None:
+                old.router.close()
+        config_version.set(value=snapshot.version)
+        logger.info("config %s loaded, version %d", self.path, snapshot.version)
+        return snapshot
+
+    def acquire(self)->Snapshot:
+        """
+        新连接使用当前的snapshot, 连接结束后调用release
+        """
+        with self._users_lock:
+            snapshot = self.snapshot
+            self._users[snapshot.version] = self._users.get(snapshot.version, 0) + 1
+        return snapshot
+
+    def release(self, snapshot: Snapshot):
+        """
+        被替换的snapshot的连接都结束之后关闭它的router, 新配置中没有的后端的连接池随之关闭
+        """
+        with self._users_lock:
+            n = self._users[snapshot.version] - 1
+            if n > 0:
+                self._users[snapshot.version] = n
+                return
+            del self._users[snapshot.version]
+            retired = self._retired.pop(snapshot.version, None)
+        if retired is not None:
+            retired.router.close()
+
+    @staticmethod
+    def _inherit(old: Snapshot, new: Snapshot):
+        """
+        地址相同的后端保留健康检查和摘除的状态
+        """
+        states = {backend.name: backend for backend in old.backends()}
+        for backend in new.backends():
+            prev = states.get(backend.name)
+            if prev is None:
+                continue
+            backend.healthy = prev.healthy
+            backend.check_ok = prev.check_ok
+            backend.check_fail = prev.check_fail
+            backend.ejected_until = prev.ejected_until
+            backend.update_gauge()
+
+    def reload(self)->bool:
+        try:
+            self.load()
+        except Exception as e:
+            config_reloads.inc("error")
+            logger.error("reload config %s failed, keep version %d cause: %s", self.path, self.snapshot.version, e)
+            return False
+        config_reloads.inc("ok")
+        return True
+
+    def request_reload(self, *_):
+        """
+        可以在信号处理函数中调用,由后台线程重新加载
+        """
+        self._reload_event.set()
+
+    def _watch_loop(self):
+        while not self._stopped.is_set():
+            if self._reload_event.wait(self.watch_interval):
+                self._reload_event.clear()
+                if not self._stopped.is_set():
+                    self.reload()
+                continue
+            stat = self._file_stat()
+            if stat is not None and stat != self._stat:
+                self.reload()
+
+    def start(self):
+        """
+        启动后台线程, 在主线程中调用时同时处理SIGHUP
+        """
+        if self._watcher is not None:
+            return
+        if threading.current_thread() is threading.main_thread() and hasattr(signal, "SIGHUP"):
+            signal.signal(signal.SIGHUP, self.request_reload)
+        self._watcher = threading.Thread(target=self._watch_loop)
+        self._watcher.setDaemon(True)
+        self._watcher.start()
+
+    def close(self):
+        self._stopped.set()
+        self._reload_event.set()
+
+    def __call__(self, info):
+        """
+        作为get_proxy时使用当前的snapshot
+        """
+        return self.snapshot.router(info)
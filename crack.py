@@ -2,70 +2,187 @@
 # @Time    : 2019-08-20 23:58
 # @File    : crack.py
 import socket
-from shared import Conn, Buffer, SocketRW
-from http_request import RequestReader, Request
+from shared import Conn, Buffer, SocketRW, EOF, DEFAULT_CHUNK_SIZE, buffer_pool
+from http_request import RequestReader, Request, parse_chunk_size, DEFAULT_MAX_HEAD_SIZE, DEFAULT_MAX_HEADERS
+
+
+# chunked body的读取状态
+CHUNK_SIZE_LINE = 1
+CHUNK_TRAILER = 2
 
 
 class CrackConn(Conn):
-    def __init__(self, _socket: socket.socket, request_handler=None):
+    def __init__(self, _socket: socket.socket, request_handler=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                 max_head_size=DEFAULT_MAX_HEAD_SIZE, max_headers=DEFAULT_MAX_HEADERS):
         """
 
         :param _socket:
         :param request_handler:
+        :param chunk_size: 每次从socket读取及每段body的字节数
+        :param max_head_size: 每个请求头最大的字节数
+        :param max_headers: 每个请求头最多的个数
         """
         """
         1.用request_reader不断读取完整的request并用request_handler进行处理
-        并将处理后的request放入v_buffer中,后续读取的body也存入v_buffer中
-        2.每次读取先从v_buffer中读取,读到则直接返回,否则进行第一步
-        3.body采取分段读取
+        并将处理后的请求头放入v_buffer中
+        2.每次读取先从v_buffer中读取,读到则直接返回
+        3.body(以及chunked编码的chunk数据)不经过v_buffer,直接从request_reader的缓存或socket读取到调用者的buffer中
+        4.body读取完之后进行第一步
         """
         # 第一个request
         self._request_handler = request_handler
+        self._chunk_size = chunk_size
         self._v_buff = Buffer()
-        self._request_reader = RequestReader(SocketRW(_socket), 512)
+        self._request_reader = RequestReader(SocketRW(_socket), chunk_size, max_head_size, max_headers)
         self._read_error = None
+        # 每读取到一个request时调用
+        self.on_request = None
         self._body_len = 0
+        # 不是chunked编码时为None
+        self._chunk_state = None
         Conn.__init__(self, _socket)
         self.request = self._read_request()
 
     def set_request_handler(self, request_handler):
         self._request_handler = request_handler
 
+    def raw_socket(self):
+        # 每个request都需要改写,不能直接拷贝socket
+        return None
+
     def recv(self, buff_size: int, flags: int = 0):
         if self._v_buff.len() > 0:
             return self._v_buff.read(buff_size)
 
-        self._read_full_request()
+        if self._body_len > 0:
+            chunk = self._request_reader.read_some(min(buff_size, self._body_len))
+            self._body_len -= len(chunk)
+            return chunk
+
+        if not self._fill_v_buff():
+            return b""
         return self._v_buff.read()
 
+    def recv_into(self, buff, nbytes: int = 0, flags: int = 0)->int:
+        if self._v_buff.len() == 0:
+            if self._body_len > 0:
+                return self._read_body_into(buff, nbytes or len(buff))
+            if not self._fill_v_buff():
+                return 0
+        return self._v_buff.read_into(buff, nbytes)
+
+    def _read_body_into(self, buff, n: int)->int:
+        """
+        body直接读取到buff中,最多读取到body结束,不会读到下一个request
+        """
+        n = self._request_reader.read_into(buff, min(n, self._body_len))
+        self._body_len -= n
+        return n
+
+    def _fill_v_buff(self)->bool:
+        """
+        客户端在两个request之间关闭连接时返回False,和socket读到EOF一致
+        """
+        body_pending = self._body_pending()
+        try:
+            self._read_full_request()
+        except EOF:
+            if body_pending:
+                raise
+            return False
+        return True
+
+    def close(self):
+        self._request_reader.release()
+        return Conn.close(self)
+
+    def write_request_to(self, target: Conn)->int:
+        """
+        把当前request(处理后的请求头和body)完整写入target
+        :return: 写入的字节数
+        """
+        copied = 0
+        slab = None
+        try:
+            while True:
+                while self._v_buff.len() > 0:
+                    chunk = self._v_buff.read(self._chunk_size)
+                    target.sendall(chunk)
+                    copied += len(chunk)
+                if self._body_len > 0:
+                    if slab is None:
+                        slab = buffer_pool.get(self._chunk_size)
+                    with memoryview(slab) as view:
+                        n = self._read_body_into(view, len(view))
+                        target.sendall(view[: n])
+                    copied += n
+                    continue
+                if self._chunk_state is None:
+                    return copied
+                self._read_chunk_line()
+        finally:
+            if slab is not None:
+                buffer_pool.put(slab)
+
+    def leftover(self)->bytes:
+        """
+        已经从socket读取但还没有处理的数据
+        """
+        n = self._request_reader.buffered()
+        return self._request_reader.read_some(n) if n > 0 else b""
+
+    def next_request(self)->Request:
+        """
+        当前request写完之后读取下一个request
+        """
+        return self._read_request()
+
     def _read_full_request(self):
         """
-        body没读取完则继续读取body
+        body的数据已经读取完(_body_len为0)时调用
+        chunked编码的body没读取完则继续读取下一行chunk-size/trailer
         :return:
         """
-        if self._body_len > 0:
-            self._read_request_body()
+        if self._chunk_state is not None:
+            self._read_chunk_line()
             return
         self._read_request()
 
+    def _body_pending(self)->bool:
+        return self._body_len > 0 or self._chunk_state is not None
+
     def _read_request(self)->Request:
         req = self._request_reader.read_request()
         self.request = req
-        self._body_len = req.content_length
+        if self.on_request:
+            self.on_request(req)
+        content_length = req.content_length
+        self._body_len = content_length
+        self._chunk_state = CHUNK_SIZE_LINE if req.chunked else None
         if self._request_handler:
             req = self._request_handler(req)
-            req.content_length = self._body_len
+            req.content_length = content_length
         self._v_buff.write(req.to_bytes())
         return req
 
-    def _read_request_body(self):
-        # 每次只读取512字节
-        read_body_size = 512
-        if read_body_size > self._body_len:
-            read_body_size = self._body_len
-        chunk = self._request_reader.read_until_n(read_body_size)
-        self._v_buff.write(chunk)
-        self._body_len -= read_body_size
+    def _read_chunk_line(self):
+        """
+        chunked编码的body原样转发,不缓存整个body
+        每次读取一行chunk-size/trailer放入v_buffer, chunk数据和普通body一样直接读取
+        """
+        line = self._request_reader.read_delimiter(b"\n")
+        self._v_buff.write(line)
+        if self._chunk_state == CHUNK_TRAILER:
+            # 空行表示body结束
+            if line.strip() == b"":
+                self._chunk_state = None
+            return
+
+        size = parse_chunk_size(line)
+        if size == 0:
+            self._chunk_state = CHUNK_TRAILER
+        else:
+            self._body_len = size + 2
 
 
 """
@@ -74,8 +191,6 @@ def request_handler(req: Request)->Request:
 """
 
 
-def crack(s: socket.socket, request_handler=None)->CrackConn:
-    return CrackConn(s, request_handler)
-
-
-
+def crack(s: socket.socket, request_handler=None, chunk_size=DEFAULT_CHUNK_SIZE,
+          max_head_size=DEFAULT_MAX_HEAD_SIZE, max_headers=DEFAULT_MAX_HEADERS)->CrackConn:
+    return CrackConn(s, request_handler, chunk_size, max_head_size, max_headers)
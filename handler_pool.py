@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2019-09-21 14:27
+# @File    : handler_pool.py
+
+import queue
+import threading
+from log import logger
+
+
+# 等待队列满了之后的处理方式
+# 直接拒绝
+OVERFLOW_REJECT = "reject"
+# 等待wait_timeout秒,还是满的再拒绝
+OVERFLOW_WAIT = "wait"
+
+
+class HandlerPool:
+    def __init__(self, max_workers=256, max_pending=1024, overflow=OVERFLOW_REJECT, wait_timeout=1.0):
+        """
+        固定上限的handler线程池,代替每个连接一个线程
+        :param max_workers: 最多同时处理的连接数(线程数),线程按需创建
+        :param max_pending: 已经accept还没有开始处理的连接最多有多少个
+        :param overflow: 等待队列满了之后的处理方式 OVERFLOW_REJECT/OVERFLOW_WAIT
+        :param wait_timeout: OVERFLOW_WAIT时最多等待的时间(秒)
+        """
+        if overflow not in (OVERFLOW_REJECT, OVERFLOW_WAIT):
+            raise ValueError("overflow must be (%s)" % ",".join((OVERFLOW_REJECT, OVERFLOW_WAIT)))
+        self.max_workers = max_workers
+        self.overflow = overflow
+        self.wait_timeout = wait_timeout
+        self._queue = queue.Queue(max_pending)
+        self._lock = threading.Lock()
+        self._workers = 0
+        self._idle = 0
+        self.rejected = 0
+
+    def _spawn_if_needed(self):
+        with self._lock:
+            if self._idle >= self._queue.qsize() or self._workers >= self.max_workers:
+                return
+            self._workers += 1
+            self._idle += 1
+        t = threading.Thread(target=self._work)
+        t.setDaemon(True)
+        t.start()
+
+    def _work(self):
+        while True:
+            handler = self._queue.get()
+            if handler is None:
+                break
+            with self._lock:
+                self._idle -= 1
+            try:
+                handler.run()
+            except Exception as e:
+                logger.exception("handler failed with %s", e)
+            finally:
+                with self._lock:
+                    self._idle += 1
+        with self._lock:
+            self._idle -= 1
+            self._workers -= 1
+
+    def submit(self, handler)->bool:
+        """
+        提交一个handler(有run方法),队列满了返回False,由调用方拒绝连接
+        """
+        try:
+            if self.overflow == OVERFLOW_WAIT:
+                self._queue.put(handler, timeout=self.wait_timeout)
+            else:
+                self._queue.put_nowait(handler)
+        except queue.Full:
+            self.rejected += 1
+            return False
+        self._spawn_if_needed()
+        return True
+
+    def stats(self)->dict:
+        return {
+            "active": self._workers - self._idle,
+            "pending": self._queue.qsize(),
+            "workers": self._workers,
+            "rejected": self.rejected,
+        }
+
+    def shutdown(self):
+        """
+        处理完已经提交的handler后退出所有线程
+        """
+        for _ in range(self._workers):
+            self._queue.put(None)
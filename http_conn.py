@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 import socket
-from http_request import Request, RequestReader
+from http_request import Request, RequestReader, DEFAULT_MAX_HEAD_SIZE, DEFAULT_MAX_HEADERS
 from shared import SharedConn, new_shared_conn, Buffer
 
 
@@ -18,8 +18,12 @@ class HttpConn(SharedConn):
         return self.request.header("Host")
 
 
-def http(_socket: socket.socket)->HttpConn:
+def http(_socket: socket.socket, max_head_size=DEFAULT_MAX_HEAD_SIZE, max_headers=DEFAULT_MAX_HEADERS)->HttpConn:
     v_buff, tee = new_shared_conn(_socket)
-    r_reader = RequestReader(tee)
-    return HttpConn(r_reader.read_request(), v_buff, _socket)
+    r_reader = RequestReader(tee, max_head_size=max_head_size, max_headers=max_headers)
+    try:
+        request = r_reader.read_request()
+    finally:
+        r_reader.release()
+    return HttpConn(request, v_buff, _socket)
 
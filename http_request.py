@@ -3,12 +3,20 @@
 # @File    : http_request.py
 
 from requests.utils import requote_uri, unquote
-from shared import Reader, Writer, EOF, BufferReader, Buffer
+from shared import Reader, Writer, EOF, BufferReader, DEFAULT_CHUNK_SIZE
 
 
 SupportMethods = {"GET", "POST", "PUT", "HEAD", "DELETE", "TRACE"}
 SupportVersions = {"HTTP/1.1", "HTTP/1.0"}
 
+HEAD_DELIMITER = b"\r\n\r\n"
+# 只用\n换行的客户端发送的头部结尾
+LF_HEAD_DELIMITERS = (b"\n\n", b"\n\r\n")
+# 请求头(包括请求行)最大字节数
+DEFAULT_MAX_HEAD_SIZE = 65536
+# 请求头最多的个数
+DEFAULT_MAX_HEADERS = 100
+
 
 class RequestError(Exception):
     pass
@@ -26,9 +34,13 @@ class RequestValueError(RequestError):
     pass
 
 
+class RequestHeadTooLargeError(RequestError):
+    pass
+
+
 class Query(dict):
     def __init__(self, params: dict = None):
-        dict.__init__(self, params)
+        dict.__init__(self, params or {})
 
     def get_value(self, k, default=None, _typ=None):
         val = self.get(k, default)
@@ -40,8 +52,207 @@ class Query(dict):
         self[k] = v
 
 
-class Request:
+class Headers:
+    """
+    保持顺序,不区分大小写,同名头可以有多个
+    值以bytes保存,访问时才解码
+    """
+    __slots__ = ("_fields", "_index", "mutations", "encoding")
+
+    def __init__(self, encoding="utf-8"):
+        # [(name, value(bytes))]
+        self._fields = []
+        # name.lower() -> 第一个同名头在_fields中的位置
+        self._index = dict()
+        # 每次修改加1,用于判断缓存的序列化结果是否还有效
+        self.mutations = 0
+        self.encoding = encoding
+
+    def _encode(self, value)->bytes:
+        if isinstance(value, bytes):
+            return value
+        return str(value).encode(self.encoding)
+
+    def _decode(self, value: bytes)->str:
+        return value.decode(self.encoding, "replace")
+
+    def _reindex(self):
+        self._index = index = dict()
+        for i, (name, _) in enumerate(self._fields):
+            index.setdefault(name.lower(), i)
+
+    def add(self, name: str, value):
+        self._index.setdefault(name.lower(), len(self._fields))
+        self._fields.append((name, self._encode(value)))
+        self.mutations += 1
+
+    def set(self, name: str, value):
+        """
+        替换所有同名的头,保留第一个的位置
+        """
+        key = name.lower()
+        i = self._index.get(key)
+        if i is None:
+            self.add(name, value)
+            return
+        self._fields[i] = (name, self._encode(value))
+        self._fields[i + 1:] = [f for f in self._fields[i + 1:] if f[0].lower() != key]
+        self._reindex()
+        self.mutations += 1
+
+    def remove(self, name: str):
+        key = name.lower()
+        if key not in self._index:
+            return
+        self._fields = [f for f in self._fields if f[0].lower() != key]
+        self._reindex()
+        self.mutations += 1
+
+    def get(self, name: str, default=None):
+        """
+        第一个同名头的值
+        """
+        i = self._index.get(name.lower())
+        if i is None:
+            return default
+        return self._decode(self._fields[i][1])
+
+    def get_raw(self, name: str)->bytes:
+        i = self._index.get(name.lower())
+        return None if i is None else self._fields[i][1]
+
+    def get_all(self, name: str)->list:
+        key = name.lower()
+        if key not in self._index:
+            return []
+        return [self._decode(value) for k, value in self._fields if k.lower() == key]
+
+    def items(self)->list:
+        return [(name, self._decode(value)) for name, value in self._fields]
+
+    def raw_items(self)->list:
+        return list(self._fields)
+
+    def keys(self)->list:
+        return [name for name, _ in self._fields]
+
+    def copy(self)->"Headers":
+        headers = Headers(self.encoding)
+        headers._fields = list(self._fields)
+        headers._index = self._index.copy()
+        return headers
+
+    def __contains__(self, name: str)->bool:
+        return name.lower() in self._index
+
+    def __getitem__(self, name: str)->str:
+        value = self.get(name)
+        if value is None:
+            raise KeyError(name)
+        return value
+
+    def __setitem__(self, name: str, value):
+        self.set(name, value)
+
+    def __delitem__(self, name: str):
+        if name not in self:
+            raise KeyError(name)
+        self.remove(name)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self)->int:
+        return len(self._fields)
+
+    def __repr__(self):
+        return "Headers(%r)" % self.items()
+
+
+class HttpMessage:
+    __slots__ = ("_headers", "_raw", "_raw_content_length", "_raw_mutations", "content_length")
+
+    def __init__(self):
+        self._headers = Headers()
+        # 解析时的原始头部或者上次序列化的结果,修改之后置为None
+        self._raw = None
+        # 生成_raw时的content_length和headers.mutations
+        self._raw_content_length = -1
+        self._raw_mutations = 0
+        # -1表示没有content-length
+        self.content_length = -1
+
+    def header(self, key, _typ=None):
+        """
+        不区分大小写,有多个时返回第一个
+        """
+        val = self._headers.get(key)
+        if val is None or _typ is None:
+            return val
+        return _typ(val)
+
+    def header_values(self, key)->list:
+        return self._headers.get_all(key)
+
+    def set_header(self, key, value):
+        self._headers.set(key, value)
+
+    def add_header(self, key, value):
+        self._headers.add(key, value)
+
+    def remove_header(self, key):
+        self._headers.remove(key)
+
+    @property
+    def headers(self)->Headers:
+        """
+        直接修改返回的Headers也会使缓存的头部失效
+        """
+        return self._headers
+
+    def start_line(self)->str:
+        raise NotImplementedError()
+
+    def to_bytes(self)->bytes:
+        """
+        没有修改过则直接返回原始的头部,否则重新生成并缓存
+        content_length>=0时覆盖Content-Length头
+        """
+        if self._raw is None or self._raw_content_length != self.content_length or \
+                self._raw_mutations != self._headers.mutations:
+            self._raw = self._serialize()
+            self._raw_content_length = self.content_length
+            self._raw_mutations = self._headers.mutations
+        return self._raw
+
+    def _serialize(self)->bytes:
+        lines = [self.start_line().encode("utf-8")]
+        content_length = b"%d" % self.content_length if self.content_length >= 0 else None
+        for k, v in self._headers.raw_items():
+            if content_length is not None and k.lower() == "content-length":
+                v, content_length = content_length, None
+            lines.append(k.encode("utf-8") + b": " + v)
+        if content_length is not None:
+            lines.append(b"Content-Length: " + content_length)
+        lines.append(b"\r\n")
+        return b"\r\n".join(lines)
+
+    def _set_raw(self, head: bytes):
+        """
+        解析完成后保存原始的头部
+        """
+        # 有只用\n换行的行或者解析时修改过头部(删除了Content-Length)时重新生成
+        self._raw = head if head.endswith(HEAD_DELIMITER) and head.count(b"\n") == head.count(b"\r\n") \
+            and self._headers.mutations == 0 else None
+        self._raw_content_length = self.content_length
+        self._raw_mutations = self._headers.mutations
+
+
+class Request(HttpMessage):
+    __slots__ = ("_method", "_uri", "_version", "chunked", "_query", "remote_addr")
+
     def __init__(self):
+        HttpMessage.__init__(self)
         # 请求方法
         self._method = None
 
@@ -51,35 +262,27 @@ class Request:
         # http版本
         self._version = None
 
-        # map
-        self._headers = None
+        # Transfer-Encoding: chunked, 此时忽略content-length
+        self.chunked = False
+        # 用到时才创建
+        self._query = None
+        # 客户端地址,转发时设置
+        self.remote_addr = None
 
-        # 如果有content则为content的length
-        # -1表示请求中没有content-length
-        self.content_length = -1
-        #
-        self.query = Query()
+    @property
+    def query(self)->Query:
+        if self._query is None:
+            self._query = Query()
+        return self._query
 
-    def to_bytes(self)->bytes:
-        buffer = Buffer()
+    @query.setter
+    def query(self, new: Query):
+        self._query = new
+
+    def start_line(self)->str:
         if self._method is None or self._uri is None or self._version is None:
             raise ValueError("invalid request")
-
-        buffer.write_str("%s " % self.method)
-        print(requote_uri(self.uri))
-        buffer.write_str("%s " % requote_uri(self.uri))
-        buffer.write_str("%s\r\n" % self.version)
-
-        if self._headers is None:
-            return buffer.bytes()
-
-        if self.content_length >= 0:
-            self._headers["Content-Length"] = self.content_length
-
-        for k, v in self._headers.items():
-            buffer.write_str("%s: %s\r\n" % (str(k), str(v)))
-        buffer.write_str("\r\n")
-        return buffer.bytes()
+        return "%s %s %s" % (self._method, requote_uri(self._uri), self._version)
 
     @property
     def method(self)->str:
@@ -92,6 +295,7 @@ class Request:
         if new not in SupportMethods:
             raise ValueError("request method must be (%s)" % ",".join(SupportMethods))
         self._method = new
+        self._raw = None
 
     @property
     def uri(self)->str:
@@ -104,6 +308,7 @@ class Request:
         if not isinstance(new, str):
             raise ValueError("invalid URI")
         self._uri = new
+        self._raw = None
 
     @property
     def version(self)->str:
@@ -116,25 +321,7 @@ class Request:
         if new not in SupportVersions:
             raise ValueError("http version must be (%s)" % ",".join(SupportVersions))
         self._version = new
-
-    def header(self, key, _typ=None):
-        if self._headers is None:
-            return None
-        val = self._headers.get(key)
-        if val is None or _typ is None:
-            return val
-        return _typ(val)
-
-    def set_header(self, key, value):
-        if self._headers is None:
-            self._headers = dict()
-        self._headers[key] = value
-
-    @property
-    def headers(self):
-        if self._headers is None:
-            return dict()
-        return self._headers.copy()
+        self._raw = None
 
 
 # 解析请求行
@@ -157,10 +344,10 @@ def parse_request_line(line)->(str, str, str):
 def parse_request_headers(line)->(str, str):
     """
 
-    :param line: request header line
+    :param line: request header line, str或bytes
     :return: key, value
     """
-    loc = line.find(": ")
+    loc = line.find(b": " if isinstance(line, bytes) else ": ")
     if loc == -1:
         raise RequestHeaderError(line)
     k, v = line[: loc], line[loc+2:]
@@ -169,27 +356,151 @@ def parse_request_headers(line)->(str, str):
     return k, v
 
 
-class RequestReader(BufferReader):
-    def __init__(self, _reader: Reader, chunk_size: int = 1024):
+def parse_headers(lines: list, encoding="utf-8")->Headers:
+    """
+    :param lines: 每个元素为一行bytes的头, name:value, 冒号后面可以没有空格,值可以为空
+    name为空或者包含空白时抛出异常, "Content-Length : 4"这样的头不能原样转发给后端
+    """
+    headers = Headers(encoding)
+    fields, index = headers._fields, headers._index
+    for line in lines:
+        loc = line.find(b":")
+        if loc <= 0 or line[loc - 1] in b" \t" or line[0] in b" \t":
+            raise RequestHeaderError(line)
+        name = line[: loc].decode(encoding)
+        index.setdefault(name.lower(), len(fields))
+        fields.append((name, line[loc+1:].strip(b" \t")))
+    return headers
+
+
+def parse_content_length(headers: Headers, chunked: bool, error=RequestValueError)->int:
+    """
+    body的长度,没有Content-Length或者是chunked编码时为-1
+    多个Content-Length的值不一致或者不是数字时抛出error
+    同时有chunked时以chunked为准并删除Content-Length,不把两种长度都转发给对端
+    """
+    values = headers.get_all("Content-Length")
+    if not values:
+        return -1
+    lengths = set(v.strip() for value in values for v in value.split(","))
+    if len(lengths) != 1:
+        raise error("conflicting content-length: %s" % ",".join(values))
+    length = lengths.pop()
+    if not length.isdigit():
+        raise error("invalid content-length: %s" % length)
+    if chunked:
+        headers.remove("Content-Length")
+        return -1
+    return int(length)
+
+
+def split_head_lines(head: bytes)->list:
+    """
+    去掉结尾的空行并分割为行, 每行可以用\r\n或者\n结尾
+    """
+    if head.endswith(HEAD_DELIMITER):
+        head = head[: -len(HEAD_DELIMITER)]
+    else:
+        for delimiter in LF_HEAD_DELIMITERS:
+            if head.endswith(delimiter):
+                head = head[: -len(delimiter)]
+                break
+    if head.count(b"\n") == head.count(b"\r\n"):
+        return head.split(b"\r\n")
+    return [line[: -1] if line.endswith(b"\r") else line for line in head.split(b"\n")]
+
+
+def parse_request_head(head: bytes, max_headers: int = DEFAULT_MAX_HEADERS, encoding="utf-8")->Request:
+    """
+    一次性解析完整的请求头
+    :param head: 请求行和请求头,可以包括结尾的空行
+    :param max_headers: 请求头最多的个数
+    :return:
+    """
+    raw = head
+    lines = split_head_lines(head)
+    if len(lines) - 1 > max_headers:
+        raise RequestHeadTooLargeError("too many headers: %d" % (len(lines) - 1))
+
+    request = Request()
+    request.method, request.uri, request.version = parse_request_line(lines[0].decode(encoding))
+    request._headers = parse_headers(lines[1:], encoding)
+    request.chunked = is_chunked(request.header("Transfer-Encoding"))
+    request.content_length = parse_content_length(request._headers, request.chunked)
+    request._set_raw(raw)
+    return request
+
+
+def is_chunked(transfer_encoding: str)->bool:
+    # chunked必须是最后一个编码
+    if transfer_encoding is None:
+        return False
+    return transfer_encoding.split(",")[-1].strip().lower() == "chunked"
+
+
+def parse_chunk_size(line: bytes)->int:
+    """
+    解析chunked编码中的chunk-size行
+    1a;name=value\r\n -> 26
+    """
+    size = line.split(b";", 1)[0].strip()
+    try:
+        return int(size, 16)
+    except ValueError:
+        raise RequestValueError("invalid chunk size: %r" % line)
+
+
+class HeadReader(BufferReader):
+    # 头部超过限制时抛出的异常
+    head_too_large_error = RequestHeadTooLargeError
+
+    def __init__(self, _reader: Reader, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                 max_head_size: int = DEFAULT_MAX_HEAD_SIZE, max_headers: int = DEFAULT_MAX_HEADERS):
         BufferReader.__init__(self, reader=_reader, chunk_size=chunk_size)
+        self.max_head_size = max_head_size
+        self.max_headers = max_headers
+
+    def read_head(self)->bytes:
+        """
+        读取完整的头部(包括结尾的空行, \r\n\r\n或者只用\n换行的\n\n)
+        每次只从上次没搜索过的位置开始查找,超过max_head_size还没找到则抛出异常
+        :return:
+        """
+        end = self._head_end(0)
+        while end == -1:
+            if len(self._buffer) >= self.max_head_size:
+                raise self.head_too_large_error("head exceeds %d bytes" % self.max_head_size)
+            # 分隔符可能跨越两次读取
+            search_loc = max(0, len(self._buffer) - len(HEAD_DELIMITER) + 1)
+            self._fill()
+            end = self._head_end(search_loc)
+
+        if end > self.max_head_size:
+            raise self.head_too_large_error("head exceeds %d bytes" % self.max_head_size)
+        head = bytes(self._buffer[: end])
+        del self._buffer[: end]
+        return head
+
+    def _head_end(self, start: int)->int:
+        """
+        :return: 头部结尾的空行之后的位置,没有找到时为-1
+        """
+        end = -1
+        # \r\n\r\n中包含\n\r\n, 只需要查找两个
+        for delimiter in LF_HEAD_DELIMITERS:
+            loc = self._buffer.find(delimiter, start)
+            if loc != -1 and (end == -1 or loc + len(delimiter) < end):
+                end = loc + len(delimiter)
+        return end
+
 
+class RequestReader(HeadReader):
     def read_request(self) -> Request:
         """
         读取一个request
         :return:
         """
-        request = Request()
-
-        line = self.read_line()
-        request.method, request.uri, request.version = parse_request_line(line)
-        header_line = self.read_line()
-        while header_line != "":
-            k, v = parse_request_headers(header_line)
-            request.set_header(k, v)
-            header_line = self.read_line()
-        cl = request.header("Content-Length", int)
-        request.content_length = cl if cl is not None else -1
-        return request
+        return parse_request_head(self.read_head(), self.max_headers)
 
 
 def write_request(request: Request, writer: Writer):
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2019-09-10 23:16
+# @File    : http_response.py
+
+from shared import EOF, Writer, DEFAULT_CHUNK_SIZE
+from http_request import HttpMessage, HeadReader, SupportVersions, DEFAULT_MAX_HEADERS, \
+    parse_headers, parse_chunk_size, is_chunked, split_head_lines, parse_content_length
+
+
+# body的长度由什么决定
+BODY_NONE = 0
+BODY_LENGTH = 1
+BODY_CHUNKED = 2
+BODY_CLOSE = 3
+
+
+class ResponseError(Exception):
+    pass
+
+
+class ResponseLineError(ResponseError):
+    pass
+
+
+class ResponseHeadTooLargeError(ResponseError):
+    pass
+
+
+class ResponseValueError(ResponseError):
+    pass
+
+
+class Response(HttpMessage):
+    __slots__ = ("_version", "_status", "_reason", "chunked")
+
+    def __init__(self):
+        HttpMessage.__init__(self)
+        # http版本
+        self._version = ""
+        # 状态码
+        self._status = 0
+        self._reason = ""
+        self.chunked = False
+
+    def start_line(self)->str:
+        return "%s %d %s" % (self._version, self._status, self._reason)
+
+    @property
+    def version(self)->str:
+        return self._version
+
+    @version.setter
+    def version(self, new):
+        if new not in SupportVersions:
+            raise ValueError("http version must be (%s)" % ",".join(SupportVersions))
+        self._version = new
+        self._raw = None
+
+    @property
+    def status(self)->int:
+        return self._status
+
+    @status.setter
+    def status(self, new):
+        self._status = int(new)
+        self._raw = None
+
+    @property
+    def reason(self)->str:
+        return self._reason
+
+    @reason.setter
+    def reason(self, new):
+        self._reason = new
+        self._raw = None
+
+    def body_mode(self, request_method: str = "GET")->int:
+        """
+        根据请求方法和响应头判断body的长度如何确定
+        """
+        if request_method == "HEAD" or 100 <= self.status < 200 or self.status in (204, 304):
+            return BODY_NONE
+        if self.chunked:
+            return BODY_CHUNKED
+        if self.content_length >= 0:
+            return BODY_LENGTH
+        return BODY_CLOSE
+
+    def keep_alive(self, request_method: str = "GET")->bool:
+        """
+        响应结束之后连接是否还可以继续使用
+        """
+        if self.body_mode(request_method) == BODY_CLOSE:
+            return False
+        connection = (self.header("Connection") or "").lower()
+        if self.version == "HTTP/1.0":
+            return connection == "keep-alive"
+        return connection != "close"
+
+
+# 解析状态行
+# HTTP/1.1 200 OK
+def parse_status_line(line: str)->(str, int, str):
+    """
+
+    :param line: status line
+    :return: version, status, reason
+    """
+    items = line.split(" ", 2)
+    if len(items) < 2 or items[0] not in SupportVersions:
+        raise ResponseLineError(line)
+    try:
+        status = int(items[1])
+    except ValueError:
+        raise ResponseLineError(line)
+    return items[0], status, items[2] if len(items) == 3 else ""
+
+
+def parse_response_head(head: bytes, max_headers: int = DEFAULT_MAX_HEADERS, encoding="utf-8")->Response:
+    """
+    一次性解析完整的响应头
+    :param head: 状态行和响应头,可以包括结尾的空行
+    :param max_headers: 响应头最多的个数
+    :return:
+    """
+    raw = head
+    lines = split_head_lines(head)
+    if len(lines) - 1 > max_headers:
+        raise ResponseHeadTooLargeError("too many headers: %d" % (len(lines) - 1))
+
+    response = Response()
+    response.version, response.status, response.reason = parse_status_line(lines[0].decode(encoding))
+    response._headers = parse_headers(lines[1:], encoding)
+    response.chunked = is_chunked(response.header("Transfer-Encoding"))
+    response.content_length = parse_content_length(response._headers, response.chunked, ResponseValueError)
+    response._set_raw(raw)
+    return response
+
+
+class ResponseReader(HeadReader):
+    head_too_large_error = ResponseHeadTooLargeError
+
+    def read_response(self)->Response:
+        """
+        读取一个响应头
+        :return:
+        """
+        return parse_response_head(self.read_head(), self.max_headers)
+
+    def copy_body(self, response: Response, writer: Writer, request_method: str = "GET",
+                  chunk_size=DEFAULT_CHUNK_SIZE)->int:
+        """
+        把response的body分段写入writer,不缓存整个body
+        :return: 写入的字节数
+        """
+        mode = response.body_mode(request_method)
+        if mode == BODY_NONE:
+            return 0
+        if mode == BODY_CHUNKED:
+            return self._copy_chunked(writer, chunk_size)
+
+        copied = 0
+        remain = response.content_length if mode == BODY_LENGTH else -1
+        while remain != 0:
+            try:
+                chunk = self.read_some(chunk_size if remain < 0 else min(chunk_size, remain))
+            except EOF:
+                # 以关闭连接结束的body
+                if mode == BODY_CLOSE:
+                    return copied
+                raise
+            writer.write(chunk)
+            copied += len(chunk)
+            if remain > 0:
+                remain -= len(chunk)
+        return copied
+
+    def _copy_chunked(self, writer: Writer, chunk_size)->int:
+        copied = 0
+        while True:
+            line = self.read_delimiter(b"\n")
+            writer.write(line)
+            copied += len(line)
+            size = parse_chunk_size(line)
+            if size == 0:
+                break
+            # chunk数据和结尾的\r\n
+            remain = size + 2
+            while remain > 0:
+                chunk = self.read_some(min(chunk_size, remain))
+                writer.write(chunk)
+                copied += len(chunk)
+                remain -= len(chunk)
+
+        # trailer,以空行结束
+        while True:
+            line = self.read_delimiter(b"\n")
+            writer.write(line)
+            copied += len(line)
+            if line.strip() == b"":
+                return copied
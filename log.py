@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2019-09-29 21:40
+# @File    : log.py
+
+import os
+import sys
+import queue
+import atexit
+import random
+import logging
+import threading
+
+
+# 运行日志
+logger = logging.getLogger("vhost")
+# 每个连接/请求一条的访问日志,可以采样
+access_logger = logging.getLogger("vhost.access")
+
+DEFAULT_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+DEFAULT_MAX_QUEUE = 10000
+DEFAULT_BATCH_SIZE = 256
+
+
+class SampleFilter(logging.Filter):
+    def __init__(self, rate: float = 1.0):
+        """
+        :param rate: 保留的比例 0~1, WARNING及以上的日志总是保留
+        """
+        logging.Filter.__init__(self)
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord)->bool:
+        if self.rate >= 1.0 or record.levelno >= logging.WARNING:
+            return True
+        return random.random() < self.rate
+
+
+class AsyncLogHandler(logging.Handler):
+    def __init__(self, stream=None, max_queue=DEFAULT_MAX_QUEUE, batch_size=DEFAULT_BATCH_SIZE):
+        """
+        emit只把record放入队列,由后台线程格式化并批量写入stream
+        队列满了直接丢弃,不阻塞处理连接的线程
+        :param stream: 默认为sys.stdout
+        :param max_queue: 队列中最多的record数
+        :param batch_size: 一次写入最多的record数
+        """
+        logging.Handler.__init__(self)
+        self.stream = stream
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.dropped = 0
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_started(self):
+        # fork之后子进程中没有写日志的线程,需要重新启动
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(self.max_queue)
+            self._thread = threading.Thread(target=self._write_loop, args=(self._queue,))
+            self._thread.setDaemon(True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def emit(self, record: logging.LogRecord):
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _write_loop(self, q: queue.Queue):
+        while True:
+            batch = [q.get()]
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(q.get_nowait())
+            except queue.Empty:
+                pass
+
+            stop = batch[-1] is None
+            lines = []
+            for record in batch:
+                if record is None:
+                    continue
+                try:
+                    lines.append(self.format(record))
+                except Exception:
+                    self.handleError(record)
+            if lines:
+                self._write("\n".join(lines) + "\n")
+            if stop:
+                return
+
+    def _write(self, data: str):
+        stream = self.stream or sys.stdout
+        try:
+            stream.write(data)
+            stream.flush()
+        except (OSError, ValueError):
+            pass
+
+    def flush(self, timeout: float = 1.0):
+        """
+        停止后台线程,写完队列中已有的日志
+        """
+        if self._pid != os.getpid():
+            return
+        with self._start_lock:
+            self._pid = None
+            try:
+                self._queue.put(None, timeout=timeout)
+            except queue.Full:
+                return
+            self._thread.join(timeout)
+
+    def close(self):
+        self.flush()
+        logging.Handler.close(self)
+
+
+_handler = None
+
+
+def setup(level=logging.INFO, access_level=logging.INFO, access_sample: float = 1.0, stream=None,
+          fmt=DEFAULT_FORMAT, max_queue=DEFAULT_MAX_QUEUE, batch_size=DEFAULT_BATCH_SIZE)->AsyncLogHandler:
+    """
+    配置vhost的日志,重复调用会替换之前的配置
+    :param level: 运行日志的级别
+    :param access_level: 访问日志的级别,大于INFO则关闭访问日志
+    :param access_sample: 访问日志的采样比例
+    """
+    global _handler
+    handler = AsyncLogHandler(stream, max_queue, batch_size)
+    handler.setFormatter(logging.Formatter(fmt))
+    if _handler is not None:
+        logger.removeHandler(_handler)
+        _handler.close()
+    _handler = handler
+
+    logger.addHandler(handler)
+    logger.setLevel(level)
+    logger.propagate = False
+    access_logger.setLevel(access_level)
+    for f in list(access_logger.filters):
+        if isinstance(f, SampleFilter):
+            access_logger.removeFilter(f)
+    if access_sample < 1.0:
+        access_logger.addFilter(SampleFilter(access_sample))
+    return handler
+
+
+def _close():
+    if _handler is not None:
+        _handler.close()
+
+
+setup()
+atexit.register(_close)
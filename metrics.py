@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2019-09-28 15:02
+# @File    : metrics.py
+
+import time
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# 每个指标最多的标签组合数,超过之后都记到OVERFLOW_LABEL下,防止host之类的标签把内存撑爆
+DEFAULT_MAX_SERIES = 1000
+OVERFLOW_LABEL = "_other"
+
+# 延迟类histogram默认的桶(秒)
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "")->str:
+    items = ['%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in zip(names, values)]
+    if extra:
+        items.append(extra)
+    return "{%s}" % ",".join(items) if items else ""
+
+
+def _format_value(v)->str:
+    if isinstance(v, float) and v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class Metric:
+    typ = "untyped"
+
+    def __init__(self, name: str, doc: str, labels: tuple = (), max_series: int = DEFAULT_MAX_SERIES):
+        """
+        :param name: 指标名
+        :param doc: 说明,输出为# HELP
+        :param labels: 标签名,记录时按顺序传入标签值
+        :param max_series: 最多的标签组合数
+        """
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self.max_series = max_series
+        self._lock = threading.Lock()
+        # 标签值 -> 值
+        self._values = dict()
+
+    def _key(self, values: tuple)->tuple:
+        """
+        需要在持有锁时调用
+        """
+        if len(values) != len(self.labels):
+            raise ValueError("%s needs labels (%s)" % (self.name, ",".join(self.labels)))
+        if values in self._values or len(self._values) < self.max_series:
+            return values
+        return (OVERFLOW_LABEL,) * len(values)
+
+    def samples(self):
+        """
+        :return: [(后缀, 标签值, 额外的标签, 值)]
+        """
+        with self._lock:
+            return [("", k, "", v) for k, v in self._values.items()]
+
+    def _args(self)->tuple:
+        return self.name, self.doc, self.labels
+
+    def snapshot(self)->tuple:
+        """
+        :return: (类, 构造参数, {标签值: 值}) 可以pickle后发给其他进程
+        """
+        with self._lock:
+            return self.__class__, self._args(), dict(self._values)
+
+    def _merge_value(self, old, v):
+        return old + v
+
+    def merge(self, values: dict):
+        """
+        把其他进程的值合并进来
+        """
+        with self._lock:
+            for k, v in values.items():
+                key = self._key(k)
+                old = self._values.get(key)
+                self._values[key] = v if old is None else self._merge_value(old, v)
+
+    def render(self)->str:
+        lines = ["# HELP %s %s" % (self.name, self.doc), "# TYPE %s %s" % (self.name, self.typ)]
+        for suffix, values, extra, v in self.samples():
+            lines.append("%s%s%s %s" % (self.name, suffix, _format_labels(self.labels, values, extra),
+                                        _format_value(v)))
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    typ = "counter"
+
+    def inc(self, *values, amount=1):
+        with self._lock:
+            key = self._key(values)
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, *values):
+        return self._values.get(values, 0)
+
+
+class Gauge(Metric):
+    typ = "gauge"
+
+    def __init__(self, name: str, doc: str, labels: tuple = (), merge: str = "sum"):
+        """
+        :param merge: 合并多个进程的值的方式, sum/min/max
+        """
+        Metric.__init__(self, name, doc, labels)
+        if merge not in ("sum", "min", "max"):
+            raise ValueError("unknown merge %s" % merge)
+        self.merge_by = merge
+
+    def _args(self)->tuple:
+        return self.name, self.doc, self.labels, self.merge_by
+
+    def _merge_value(self, old, v):
+        if self.merge_by == "min":
+            return min(old, v)
+        if self.merge_by == "max":
+            return max(old, v)
+        return old + v
+
+    def inc(self, *values, amount=1):
+        with self._lock:
+            key = self._key(values)
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, *values, amount=1):
+        self.inc(*values, amount=-amount)
+
+    def set(self, *values, value=0):
+        with self._lock:
+            self._values[self._key(values)] = value
+
+    def value(self, *values):
+        return self._values.get(values, 0)
+
+
+class Histogram(Metric):
+    typ = "histogram"
+
+    def __init__(self, name: str, doc: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        Metric.__init__(self, name, doc, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, *values, amount: float):
+        """
+        :param amount: 观测值,延迟类为秒
+        """
+        # 每个桶只记录落在自己区间内的个数,输出时再累加
+        i = bisect.bisect_left(self.buckets, amount)
+        with self._lock:
+            key = self._key(values)
+            state = self._values.get(key)
+            if state is None:
+                # [各个桶的个数..., +Inf桶的个数, sum]
+                self._values[key] = state = [0] * (len(self.buckets) + 1) + [0.0]
+            state[i] += 1
+            state[-1] += amount
+
+    def _args(self)->tuple:
+        return self.name, self.doc, self.labels, self.buckets
+
+    def snapshot(self)->tuple:
+        with self._lock:
+            return self.__class__, self._args(), {k: list(v) for k, v in self._values.items()}
+
+    def _merge_value(self, old, v):
+        return [a + b for a, b in zip(old, v)]
+
+    def time(self, *values):
+        """
+        with histogram.time(label): ... 记录代码块的耗时
+        """
+        return _Timer(self, values)
+
+    def samples(self):
+        with self._lock:
+            items = [(k, list(v)) for k, v in self._values.items()]
+        samples = []
+        for values, state in items:
+            total = 0
+            for bound, n in zip(self.buckets + (float("inf"),), state[: -1]):
+                total += n
+                samples.append(("_bucket", values, 'le="%s"' % _format_value(bound), total))
+            samples.append(("_sum", values, "", state[-1]))
+            samples.append(("_count", values, "", total))
+        return samples
+
+
+class _Timer:
+    __slots__ = ("histogram", "values", "start")
+
+    def __init__(self, histogram: Histogram, values: tuple):
+        self.histogram = histogram
+        self.values = values
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_):
+        self.histogram.observe(*self.values, amount=time.perf_counter() - self.start)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = dict()
+        self._lock = threading.Lock()
+
+    def _register(self, metric: Metric)->Metric:
+        with self._lock:
+            old = self._metrics.get(metric.name)
+            if old is not None:
+                if type(old) is not type(metric) or old.labels != metric.labels:
+                    raise ValueError("metric %s already registered with different type or labels" % metric.name)
+                return old
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name: str, doc: str, labels: tuple = ())->Counter:
+        return self._register(Counter(name, doc, labels))
+
+    def gauge(self, name: str, doc: str, labels: tuple = (), merge: str = "sum")->Gauge:
+        return self._register(Gauge(name, doc, labels, merge))
+
+    def histogram(self, name: str, doc: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS)->Histogram:
+        return self._register(Histogram(name, doc, labels, buckets))
+
+    def render(self)->str:
+        """
+        prometheus文本格式
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(m.render() for m in metrics) + "\n"
+
+    def snapshot(self)->list:
+        """
+        所有指标当前的值,用于把worker进程的指标发给master
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return [m.snapshot() for m in metrics]
+
+    def merge(self, snapshot: list):
+        """
+        合并其他进程的snapshot, counter和histogram相加, gauge按创建时的merge方式
+        """
+        for cls, args, values in snapshot:
+            self._register(cls(*args)).merge(values)
+
+
+registry = Registry()
+
+# proxy使用的指标
+connections_accepted = registry.counter("vhost_connections_accepted_total", "Accepted client connections.",
+                                        ("listen",))
+connections_rejected = registry.counter("vhost_connections_rejected_total",
+                                        "Client connections rejected because the handler pool was full.",
+                                        ("listen",))
+connections_active = registry.gauge("vhost_connections_active", "Client connections being handled.", ("listen",))
+sniff_seconds = registry.histogram("vhost_sniff_seconds",
+                                   "Time spent reading and parsing the first request or ClientHello.", ("kind",))
+backend_connect_seconds = registry.histogram("vhost_backend_connect_seconds",
+                                             "Time spent in get_proxy choosing and connecting a backend.", ("vhost",))
+bytes_copied = registry.counter("vhost_bytes_total", "Bytes relayed, by vhost and direction.",
+                                ("vhost", "direction"))
+errors = registry.counter("vhost_errors_total", "Errors by stage and exception type.", ("stage", "type"))
+
+
+def record_error(stage: str, e: BaseException):
+    errors.inc(stage, e.__class__.__name__)
+
+
+def record_bytes(vhost: str, from_bytes: int, to_bytes: int):
+    """
+    :param from_bytes: 客户端 -> 后端
+    :param to_bytes: 后端 -> 客户端
+    """
+    vhost = vhost or "-"
+    if from_bytes:
+        bytes_copied.inc(vhost, "in", amount=from_bytes)
+    if to_bytes:
+        bytes_copied.inc(vhost, "out", amount=to_bytes)
+
+
+class _StatsHandler(BaseHTTPRequestHandler):
+    registry = registry
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        # 不打印每次抓取
+        pass
+
+
+class StatsServer(threading.Thread):
+    def __init__(self, host="127.0.0.1", port=9100, _registry: Registry = registry):
+        """
+        在后台线程中提供 GET /metrics,输出prometheus文本格式
+        """
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        handler = type("StatsHandler", (_StatsHandler,), {"registry": _registry})
+        self._server = ThreadingHTTPServer((host, port), handler)
+        self._server.daemon_threads = True
+        self.server_addr = self._server.server_address
+
+    def run(self):
+        self._server.serve_forever()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def serve_stats(host="127.0.0.1", port=9100)->StatsServer:
+    server = StatsServer(host, port)
+    server.start()
+    return server
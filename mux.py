@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2019-09-18 21:05
+# @File    : mux.py
+
+import socket
+from shared import SharedConn, Buffer, MultiReader, new_shared_conn, DEFAULT_CHUNK_SIZE
+from http_request import RequestReader, DEFAULT_MAX_HEAD_SIZE, DEFAULT_MAX_HEADERS
+from http_conn import HttpConn
+from tls import TlsConn, read_client_hello, CONTENT_TYPE_HANDSHAKE
+
+
+def detect(_socket: socket.socket, max_head_size=DEFAULT_MAX_HEAD_SIZE, max_headers=DEFAULT_MAX_HEADERS)->SharedConn:
+    """
+    根据第一个字节判断协议, 0x16(tls handshake record)为tls, 其余按http处理
+    已经读取的数据都在v_buff中,转发时会回放给后端
+    :return: TlsConn或者HttpConn
+    """
+    v_buff, tee = new_shared_conn(_socket)
+    first = tee.read(DEFAULT_CHUNK_SIZE)
+    # 第一次读取的数据已经在v_buff中,不需要再经过tee
+    reader = MultiReader(Buffer(first), tee)
+
+    if first[0] == CONTENT_TYPE_HANDSHAKE:
+        return TlsConn(_socket, v_buff, read_client_hello(reader))
+
+    r_reader = RequestReader(reader, max_head_size=max_head_size, max_headers=max_headers)
+    try:
+        request = r_reader.read_request()
+    finally:
+        r_reader.release()
+    return HttpConn(request, v_buff, _socket)
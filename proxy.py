@@ -2,94 +2,566 @@
 # @Time    : 2019-08-21 17:19
 # @File    : proxy.py
 
+import queue
 import socket
+import weakref
 import threading
-from shared import Conn, io_copy
+from shared import Conn, SharedConn, Buffer, EOF, SocketRW, io_copy, DEFAULT_CHUNK_SIZE
 from http_conn import http
+from tls import tls, TlsConn
+from mux import detect
 from crack import crack
-from http_request import Request
+from http_request import Request, DEFAULT_MAX_HEAD_SIZE, DEFAULT_MAX_HEADERS
+from http_response import Response, ResponseReader
+from router import normalize_host, route_host
+from upstream import is_alive
+from rewrite import Rule, RuleSet
+from handler_pool import HandlerPool
+from relay import relay
+from log import logger, access_logger
+from timers import Deadline, DeadlineExceeded, IdleWatchdog, abort_socket
+from metrics import connections_accepted, connections_rejected, connections_active, sniff_seconds, \
+    backend_connect_seconds, record_bytes, record_error, serve_stats
+
+
+# listen的backlog
+DEFAULT_BACKLOG = 128
+# 读取第一个请求/clientHello的总时间(秒)
+DEFAULT_SNIFF_TIMEOUT = 10.0
+
+
+class WatchedConn(Conn):
+    def __init__(self, conn: Conn, watchdog: IdleWatchdog):
+        """
+        每次读写之后调用watchdog.touch()
+        raw_socket返回None, 不走splice,这样每次读取都能被观察到
+        """
+        Conn.__init__(self, conn.socket)
+        self._conn = conn
+        self._watchdog = watchdog
+
+    def slab(self, size=DEFAULT_CHUNK_SIZE)->bytearray:
+        return self._conn.slab(size)
+
+    def recv(self, buff_size: int, flags: int = 0):
+        data = self._conn.recv(buff_size, flags)
+        self._watchdog.touch()
+        return data
+
+    def recv_into(self, buff, nbytes: int = 0, flags: int = 0)->int:
+        n = self._conn.recv_into(buff, nbytes, flags)
+        self._watchdog.touch()
+        return n
+
+    def send(self, data: bytes, flags: int = 0):
+        n = self._conn.send(data, flags)
+        self._watchdog.touch()
+        return n
+
+    def sendall(self, data: bytes, flags: int = 0):
+        self._conn.sendall(data, flags)
+        self._watchdog.touch()
+
+    def shutdown(self, how: int):
+        return self._conn.shutdown(how)
+
+    def close(self):
+        # 由被包装的conn负责关闭
+        pass
+
+    def raw_socket(self):
+        return None
 
 
 class Pipe(threading.Thread):
-    def __init__(self, from_conn: Conn, to_conn: Conn):
-        self.from_conn = from_conn
+    def __init__(self, from_conn: Conn, to_conn: Conn, chunk_size=DEFAULT_CHUNK_SIZE, watchdog: IdleWatchdog = None):
+        """
+        :param watchdog: 设置了则每次读到数据时touch
+        """
+        self.from_conn = from_conn if watchdog is None else WatchedConn(from_conn, watchdog)
         self.to_conn = to_conn
+        self.chunk_size = chunk_size
+        threading.Thread.__init__(self)
+        self.from_bytes = 0
+        # 结束时调用
+        self.on_finish = None
+
+    def run(self):
+        try:
+            self.from_bytes = io_copy(self.from_conn, self.to_conn, chunk_size=self.chunk_size)
+        except Exception as e:
+            record_error("relay", e)
+            logger.info("relay broken cause: %s", e)
+        finally:
+            # 把半关闭传递给对端,另一个方向的Pipe才能结束
+            try:
+                self.to_conn.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+            if self.on_finish:
+                self.on_finish()
+
+
+def copy_response(reader: ResponseReader, writer: SocketRW, request_method: str, response_handler=None,
+                  chunk_size=DEFAULT_CHUNK_SIZE)->(Response, int):
+    """
+    从reader中读取一个完整的响应(包括之前的1xx响应),用response_handler处理后写入writer
+    :return: 最终的response, 写入的字节数
+    """
+    copied = 0
+    while True:
+        response = reader.read_response()
+        content_length = response.content_length
+        if response_handler:
+            response = response_handler(response)
+            response.content_length = content_length
+        head = response.to_bytes()
+        writer.write(head)
+        copied += len(head)
+        copied += reader.copy_body(response, writer, request_method, chunk_size)
+        # 101之后不再是http, 其余的1xx之后还有最终的响应
+        if not 100 <= response.status < 200 or response.status == 101:
+            return response, copied
+
+
+def run_pipes(p1: threading.Thread, p2: threading.Thread, watchdog: IdleWatchdog = None):
+    """
+    启动两个方向的Pipe并等待结束,watchdog在这期间生效
+    """
+    p1.setDaemon(True)
+    p2.setDaemon(True)
+    if watchdog is not None:
+        watchdog.start()
+    p1.start()
+    p2.start()
+    try:
+        p1.join()
+        p2.join()
+    finally:
+        if watchdog is not None:
+            watchdog.stop()
+            if watchdog.idle:
+                logger.info("relay idle for %ss, closing", watchdog.timeout)
+
+
+class ResponsePipe(threading.Thread):
+    def __init__(self, from_conn: Conn, to_conn: Conn, response_handler=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                 watchdog: IdleWatchdog = None):
+        """
+        按响应逐个转发,每个响应用response_handler处理
+        每个请求的方法需要放入methods中,用于判断响应有没有body(HEAD)
+        请求方向结束后调用end_requests, 否则会一直等待下一个请求
+        """
         threading.Thread.__init__(self)
+        self.from_conn = from_conn if watchdog is None else WatchedConn(from_conn, watchdog)
+        self.to_conn = to_conn
+        self.response_handler = response_handler
+        self.chunk_size = chunk_size
+        self.methods = queue.Queue()
         self.from_bytes = 0
 
+    def end_requests(self):
+        self.methods.put(None)
+
     def run(self):
+        # WatchedConn和socket一样有recv/recv_into
+        src = self.from_conn if isinstance(self.from_conn, WatchedConn) else self.from_conn.socket
+        reader = ResponseReader(SocketRW(src), self.chunk_size)
+        writer = SocketRW(self.to_conn.socket)
         try:
-            self.from_bytes = io_copy(self.from_conn, self.to_conn)
+            while True:
+                method = self.methods.get()
+                if method is None:
+                    # 客户端不会再发送请求
+                    return
+                response, copied = copy_response(reader, writer, method, self.response_handler, self.chunk_size)
+                self.from_bytes += copied
+                if response.status == 101 or not response.keep_alive(method):
+                    break
+            # 101或者后端不再复用连接,剩下的数据直接转发
+            while True:
+                chunk = reader.read_some(self.chunk_size)
+                writer.write(chunk)
+                self.from_bytes += len(chunk)
+        except EOF:
+            pass
         except Exception as e:
-            print(e)
+            record_error("relay", e)
+            logger.info("relay broken cause: %s", e)
+        finally:
+            reader.release()
+            try:
+                self.to_conn.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
 
 
 class HandlerConn(threading.Thread):
-    def __init__(self, s: socket.socket, get_proxy_func):
+    # 嗅探耗时指标的标签
+    sniff_kind = "http"
+
+    def __init__(self, s: socket.socket, get_proxy_func, chunk_size=DEFAULT_CHUNK_SIZE):
         threading.Thread.__init__(self)
         self._socket = s
         self.get_proxy_func = get_proxy_func
+        self.chunk_size = chunk_size
+        # 转发时超过这个时间(秒)两边都没有数据则关闭连接
+        self.idle_timeout = None
+        # 读取第一个请求的总时间(秒),None表示不限制
+        self.sniff_timeout = None
+        # 请求头的限制,由Proxy设置
+        self.max_head_size = DEFAULT_MAX_HEAD_SIZE
+        self.max_headers = DEFAULT_MAX_HEADERS
+        # 监听地址,指标的标签
+        self.listen = "-"
+        # 连接处理结束时调用
+        self.on_close = None
 
         self.from_bytes, self.to_bytes = 0, 0
 
     def wrap_conn(self):
-        return http(self._socket)
+        return http(self._socket, self.max_head_size, self.max_headers)
 
-    def run(self):
+    def route_info(self, conn: Conn):
+        """
+        传给get_proxy的参数
+        """
+        return conn.request
+
+    def relay(self, conn: Conn, proxy: Conn)->(int, int):
+        """
+        双向转发,返回 conn->proxy, proxy->conn 的字节数
+        """
+        return relay(conn, proxy, self.idle_timeout, self.chunk_size)
+
+    def sniff(self):
+        """
+        wrap_conn并记录耗时,失败时关闭socket返回None
+        """
         try:
-            http_conn = self.wrap_conn()
-            request = http_conn.request
-            proxy = self.get_proxy_func(request)
-            if proxy is None:
-                raise Exception("get proxy is none")
+            with sniff_seconds.time(self.sniff_kind), Deadline(self.sniff_timeout, [self._socket]):
+                return self.wrap_conn()
         except Exception as e:
-            print("get proxy failed cause: %s" % e)
+            record_error("sniff", e)
+            logger.info("read request failed cause: %s", e)
             self._socket.close()
+            return None
+
+    def client_addr(self, conn: Conn):
+        """
+        客户端地址, 客户端已经reset时关闭conn并返回None
+        """
+        try:
+            return conn.socket.getpeername()
+        except OSError as e:
+            record_error("sniff", e)
+            logger.info("client gone before routing cause: %s", e)
+            conn.close()
+            return None
+
+    def connect(self, info, vhost: str)->socket.socket:
+        with backend_connect_seconds.time(vhost):
+            s = self.get_proxy_func(info)
+        if s is None:
+            raise Exception("get proxy is none")
+        return s
+
+    def run(self):
+        connections_active.inc(self.listen)
+        try:
+            self.handle()
+        finally:
+            connections_active.dec(self.listen)
+            if self.on_close is not None:
+                self.on_close()
+
+    def handle(self):
+        http_conn = self.sniff()
+        if http_conn is None:
+            return
+        from_addr = self.client_addr(http_conn)
+        if from_addr is None:
+            return
+        info = self.route_info(http_conn)
+        info.remote_addr = from_addr
+        vhost = route_host(info)
+        try:
+            proxy = self.connect(info, vhost)
+        except Exception as e:
+            record_error("connect", e)
+            logger.warning("get proxy failed cause: %s", e)
+            http_conn.close()
             return
 
         proxy = Conn(proxy)
-        # make pipe
-        p1 = Pipe(http_conn, proxy)
-        p2 = Pipe(proxy, http_conn)
-        # set daemon
-        p1.setDaemon(True)
-        p2.setDaemon(True)
-        # start and join
-        p1.start()
-        p2.start()
-        p1.join()
-        p2.join()
-        # close conn
-        http_conn.close()
-        proxy.close()
+        to_addr = None
+        try:
+            # 后端在转发之前reset时getpeername也会失败,两边的socket都要关闭
+            to_addr = proxy.socket.getpeername()
+            self.from_bytes, self.to_bytes = self.relay(http_conn, proxy)
+        except OSError as e:
+            record_error("relay", e)
+            logger.info("relay broken cause: %s", e)
+        finally:
+            # close conn
+            http_conn.close()
+            proxy.close()
+            record_bytes(vhost, self.from_bytes, self.to_bytes)
 
-        from_addr = ":".join(http_conn.socket.getpeername())
-        to_addr = ":".join(proxy.socket.getpeername())
-        # logging
-        print("%d(from), %d(to) bytes copied between %s and %s before break" % (p1.from_bytes, p2.from_bytes, from_addr,
-                                                                                to_addr))
+        access_logger.info("%d(from), %d(to) bytes copied between %s and %s(%s) before break",
+                           self.from_bytes, self.to_bytes, from_addr, to_addr, vhost)
 
 
 class HandleCrackConn(HandlerConn):
-    def __init__(self, s: socket.socket, get_proxy_func, request_handler=None):
-        HandlerConn.__init__(self, s, get_proxy_func)
+    sniff_kind = "crack"
+
+    def __init__(self, s: socket.socket, get_proxy_func, request_handler=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                 response_handler=None):
+        HandlerConn.__init__(self, s, get_proxy_func, chunk_size)
         self.request_handler = request_handler
+        self.response_handler = response_handler
+
+    def wrap_conn(self):
+        return crack(self._socket, self.request_handler, self.chunk_size, self.max_head_size, self.max_headers)
+
+    def relay(self, crack_conn: Conn, proxy: Conn)->(int, int):
+        """
+        CrackConn读取时会阻塞解析请求,不能用selectors,每个方向一个Pipe
+        """
+        watchdog = self.idle_watchdog(crack_conn, proxy)
+        p1 = Pipe(crack_conn, proxy, self.chunk_size, watchdog)
+        p2 = self.response_pipe(proxy, crack_conn, watchdog)
+        if isinstance(p2, ResponsePipe):
+            # 请求方向结束后不会再有新的响应
+            p1.on_finish = p2.end_requests
+        run_pipes(p1, p2, watchdog)
+        return p1.from_bytes, p2.from_bytes
+
+    def idle_watchdog(self, a: Conn, b: Conn)->IdleWatchdog:
+        """
+        Pipe阻塞读写,空闲超时由时间轮检查,超时后shutdown两边的socket
+        """
+        if self.idle_timeout is None:
+            return None
+
+        def on_idle():
+            abort_socket(a.socket)
+            abort_socket(b.socket)
+        return IdleWatchdog(self.idle_timeout, on_idle)
+
+    def response_pipe(self, proxy: Conn, crack_conn, watchdog: IdleWatchdog = None)->Pipe:
+        if self.response_handler is None:
+            return Pipe(proxy, crack_conn, self.chunk_size, watchdog)
+        pipe = ResponsePipe(proxy, crack_conn, self.response_handler, self.chunk_size, watchdog)
+        # 第一个request在wrap_conn时已经读取
+        pipe.methods.put(crack_conn.request.method)
+        crack_conn.on_request = lambda req: pipe.methods.put(req.method)
+        return pipe
+
+
+class HandleTlsConn(HandlerConn):
+    sniff_kind = "tls"
+
+    def __init__(self, s: socket.socket, get_proxy_func, chunk_size=DEFAULT_CHUNK_SIZE, sniff_timeout=5.0):
+        """
+        根据clientHello中的SNI路由,不解密tls
+        get_proxy的参数为ClientHello
+        :param sniff_timeout: 读取clientHello的超时时间(秒)
+        """
+        HandlerConn.__init__(self, s, get_proxy_func, chunk_size)
+        self.sniff_timeout = sniff_timeout
+
+    def wrap_conn(self):
+        return tls(self._socket)
+
+    def route_info(self, conn: Conn):
+        return conn.client_hello
+
+
+class HandleMuxConn(HandleTlsConn):
+    """
+    同一个端口同时处理http和tls
+    get_proxy的参数为Request(http)或者ClientHello(tls)
+    """
+    sniff_kind = "mux"
 
     def wrap_conn(self):
-        return crack(self._socket, self.request_handler)
+        return detect(self._socket, self.max_head_size, self.max_headers)
+
+    def route_info(self, conn: Conn):
+        if isinstance(conn, TlsConn):
+            return conn.client_hello
+        return conn.request
+
+
+class HandleKeepAliveCrackConn(HandleCrackConn):
+    """
+    keep-alive连接上每个request单独路由
+    同一个连接上不同host的请求转发到各自的后端,读取完整的响应写回客户端后再处理下一个请求
+    """
+    def _backend(self, backends: dict, request: Request)->(Conn, ResponseReader):
+        key = normalize_host(request.header("Host"))
+        backend = backends.get(key)
+        if backend is not None:
+            # 后端已经关闭了空闲的连接则重新连接
+            if backend[1].buffered() == 0 and is_alive(backend[0].socket):
+                return backend
+            self._drop_backend(backends, request)
+        try:
+            s = self.connect(request, key)
+        except Exception as e:
+            record_error("connect", e)
+            raise
+        proxy = Conn(s)
+        backends[key] = backend = (proxy, ResponseReader(SocketRW(s), self.chunk_size))
+        return backend
+
+    @staticmethod
+    def _drop_backend(backends: dict, request: Request):
+        backend = backends.pop(normalize_host(request.header("Host")), None)
+        if backend is not None:
+            backend[1].release()
+            backend[0].close()
+
+    def _upgrade(self, crack_conn, proxy: Conn, reader: ResponseReader):
+        """
+        101 Switching Protocols之后两边直接转发
+        """
+        # 已经读到缓存中的数据先写回客户端
+        if reader.buffered() > 0:
+            SocketRW(crack_conn.socket).write(reader.read_some(reader.buffered()))
+        # 客户端之后发送的不再是http请求,不能再经过CrackConn
+        client = SharedConn(crack_conn.socket, Buffer(crack_conn.leftover()))
+        watchdog = self.idle_watchdog(client, proxy)
+        p1 = Pipe(client, proxy, self.chunk_size, watchdog)
+        p2 = Pipe(proxy, client, self.chunk_size, watchdog)
+        run_pipes(p1, p2, watchdog)
+        self.from_bytes += p1.from_bytes
+        self.to_bytes += p2.from_bytes
+        record_bytes(normalize_host(crack_conn.request.header("Host")), p1.from_bytes, p2.from_bytes)
+
+    def _exchange(self, crack_conn, backends: dict, request: Request):
+        """
+        把request写入后端,再把完整的响应写回客户端
+        复用的连接在收到响应之前被后端关闭时,没有body的请求在新的连接上重发一次
+        期间超过idle_timeout秒没有写入任何数据则shutdown两边,抛出DeadlineExceeded
+        :return: proxy, reader, response, 写入后端的字节数, 写回客户端的字节数
+        """
+        reused = normalize_host(request.header("Host")) in backends
+        # 有body的请求body已经被读取,不能重发
+        head = request.to_bytes() if reused and request.content_length <= 0 and not request.chunked else None
+        proxy, reader = self._backend(backends, request)
+        # 重试时替换为新的后端socket
+        sockets = [crack_conn.socket, proxy.socket]
+
+        def on_idle():
+            for s in sockets:
+                abort_socket(s)
+        watchdog = IdleWatchdog(self.idle_timeout, on_idle).start() if self.idle_timeout is not None else None
+
+        def watched(conn: Conn)->Conn:
+            return conn if watchdog is None else WatchedConn(conn, watchdog)
+        try:
+            try:
+                from_bytes = crack_conn.write_request_to(watched(proxy))
+                reader.wait_data()
+            except (EOF, ConnectionError) as e:
+                if head is None or (watchdog is not None and watchdog.idle):
+                    raise
+                logger.info("reused backend connection broken cause: %s, retry on a new connection",
+                            type(e).__name__)
+                self._drop_backend(backends, request)
+                proxy, reader = self._backend(backends, request)
+                sockets[1] = proxy.socket
+                watched(proxy).sendall(head)
+                from_bytes = len(head)
+            response, to_bytes = copy_response(reader, SocketRW(watched(crack_conn)), request.method,
+                                               self.response_handler, self.chunk_size)
+        finally:
+            if watchdog is not None:
+                watchdog.stop()
+                if watchdog.idle:
+                    raise DeadlineExceeded("no data for %ss" % self.idle_timeout)
+        return proxy, reader, response, from_bytes, to_bytes
+
+    def handle(self):
+        crack_conn = self.sniff()
+        if crack_conn is None:
+            return
+
+        from_addr = self.client_addr(crack_conn)
+        if from_addr is None:
+            return
+        backends = dict()
+        request = crack_conn.request
+        n_requests = 0
+        try:
+            while True:
+                request.remote_addr = from_addr
+                proxy, reader, response, from_bytes, to_bytes = self._exchange(crack_conn, backends, request)
+                self.from_bytes += from_bytes
+                self.to_bytes += to_bytes
+                record_bytes(normalize_host(request.header("Host")), from_bytes, to_bytes)
+                n_requests += 1
+                if response.status == 101:
+                    self._upgrade(crack_conn, proxy, reader)
+                    break
+                if not response.keep_alive(request.method):
+                    # 读到EOF才结束的body只有关闭连接客户端才知道已经结束, Connection: close也需要关闭
+                    break
+                # keep-alive连接上等待下一个请求最多idle_timeout秒
+                with Deadline(self.idle_timeout, [crack_conn.socket]):
+                    request = crack_conn.next_request()
+        except EOF:
+            pass
+        except DeadlineExceeded:
+            logger.info("keep-alive connection idle for %ss, closing", self.idle_timeout)
+        except Exception as e:
+            record_error("relay", e)
+            logger.info("proxy request failed cause: %s", e)
+
+        for proxy, reader in backends.values():
+            reader.release()
+            proxy.close()
+        crack_conn.close()
+        access_logger.info("%d(from), %d(to) bytes copied between %s and backends in %d requests before break",
+                           self.from_bytes, self.to_bytes, from_addr, n_requests)
 
 
 class Proxy:
-    def __init__(self, get_proxy, server_host="127.0.0.1", server_port=9999, backlog=5):
+    def __init__(self, get_proxy, server_host="127.0.0.1", server_port=9999, backlog=DEFAULT_BACKLOG,
+                 chunk_size=DEFAULT_CHUNK_SIZE, max_head_size=DEFAULT_MAX_HEAD_SIZE, max_headers=DEFAULT_MAX_HEADERS):
         """
        
         :param get_proxy: 获取proxy方法,第一个参数默认为request
         :param server_host: 服务监听地址
         :param server_port: 服务监听端口
+        :param chunk_size: 转发时每次读取的字节数
+        :param max_head_size: 请求头最大的字节数
+        :param max_headers: 请求头最多的个数
         """""
         self.get_proxy = get_proxy
         self.backlog = backlog
+        self.chunk_size = chunk_size
+        self.max_head_size = max_head_size
+        self.max_headers = max_headers
         self.server_addr = (server_host, server_port)
+        # 多个进程监听同一个地址时设置
+        self.reuse_port = False
+        # 转发时的空闲超时(秒)
+        self.idle_timeout = None
+        # 读取第一个请求/clientHello的总时间(秒)
+        self.sniff_timeout = DEFAULT_SNIFF_TIMEOUT
+        # 设置了则由线程池处理连接,否则每个连接一个线程
+        self.handler_pool: HandlerPool = None
+        self.accepted = 0
+        self.rejected = 0
+        # 设置了则在这个地址上提供/metrics
+        self.stats_addr: (str, int) = None
+        # 设置了ConfigManager则每个连接使用accept时的配置(路由/改写规则/超时)
+        self.config = None
+        self._listen = "%s:%d" % self.server_addr
+        self._handlers = weakref.WeakSet()
         self._server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self._server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
@@ -98,29 +570,91 @@ class Proxy:
             self._server_socket.close()
 
     def _handler_conn(self, client_s: socket.socket):
-        return HandlerConn(client_s, self.get_proxy)
+        return HandlerConn(client_s, self.get_proxy, self.chunk_size)
 
     def _accept(self):
-        client_s, _ = self._server_socket.accept()
-        print("-----------accept connection from %s ------------" % str(client_s.getpeername()))
+        client_s, client_addr = self._server_socket.accept()
+        try:
+            self._dispatch(client_s, client_addr)
+        except OSError as e:
+            # 客户端连接之后马上reset等只影响这一个连接
+            record_error("accept", e)
+            logger.info("dispatch connection from %s failed cause: %s", client_addr, e)
+            client_s.close()
+
+    def _dispatch(self, client_s: socket.socket, client_addr):
+        logger.debug("accept connection from %s", client_addr)
+        self.accepted += 1
+        connections_accepted.inc(self._listen)
         handler_thread = self._handler_conn(client_s)
+        handler_thread.idle_timeout = self.idle_timeout
+        handler_thread.sniff_timeout = self.sniff_timeout
+        handler_thread.max_head_size = self.max_head_size
+        handler_thread.max_headers = self.max_headers
+        handler_thread.listen = self._listen
+        if self.config is not None:
+            config, snapshot = self.config, self.config.acquire()
+            snapshot.bind(handler_thread)
+            handler_thread.on_close = lambda: config.release(snapshot)
+        if self.handler_pool is not None:
+            if not self.handler_pool.submit(handler_thread):
+                self._reject(client_s, client_addr)
+                if handler_thread.on_close is not None:
+                    handler_thread.on_close()
+            return
         handler_thread.setDaemon(True)
         handler_thread.start()
+        self._handlers.add(handler_thread)
+
+    def _reject(self, client_s: socket.socket, client_addr):
+        """
+        线程池满了,直接关闭连接
+        :param client_addr: accept返回的地址, 连接可能已经被reset, 不能再getpeername
+        """
+        self.rejected += 1
+        connections_rejected.inc(self._listen)
+        logger.warning("too many connections, reject connection from %s", client_addr)
+        client_s.close()
+
+    def stats(self)->dict:
+        if self.handler_pool is not None:
+            stats = self.handler_pool.stats()
+            stats.update(accepted=self.accepted, rejected=self.rejected)
+            return stats
+        return {
+            "accepted": self.accepted,
+            "active": sum(1 for h in list(self._handlers) if h.is_alive()),
+        }
 
     def listen_and_accept(self):
 
         if self._server_socket is None:
             raise Exception("server has not init")
 
+        if self.reuse_port:
+            self._server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self._server_socket.bind(self.server_addr)
-        print("server listen at: %s: %d" % (self.server_addr[0], self.server_addr[1]))
+        logger.info("server listen at: %s: %d", self.server_addr[0], self.server_addr[1])
         self._server_socket.listen(self.backlog)
+        if self.stats_addr is not None:
+            try:
+                serve_stats(*self.stats_addr)
+            except OSError as e:
+                # 没有/metrics也继续转发
+                logger.error("serve stats at %s failed cause: %s", self.stats_addr, e)
+        if self.config is not None:
+            self.config.start()
 
         try:
             while True:
-                self._accept()
+                try:
+                    self._accept()
+                except ConnectionError as e:
+                    # accept之前客户端已经断开(ECONNABORTED), 继续accept
+                    record_error("accept", e)
+                    logger.info("accept failed cause: %s", e)
         except Exception as e:
-            print("server failed with %s , closing" % e)
+            logger.error("server failed with %s , closing", e)
         finally:
             if self._server_socket:
                 self._server_socket.close()
@@ -131,29 +665,61 @@ class Proxy:
 
 
 class CrackProxy(Proxy):
-    def __init__(self, get_proxy, server_host="127.0.0.1", server_port=9999, backlog=5, request_handler=None):
-        Proxy.__init__(self, get_proxy, server_host, server_port, backlog)
+    def __init__(self, get_proxy, server_host="127.0.0.1", server_port=9999, backlog=DEFAULT_BACKLOG,
+                 request_handler=None, chunk_size=DEFAULT_CHUNK_SIZE, response_handler=None,
+                 max_head_size=DEFAULT_MAX_HEAD_SIZE, max_headers=DEFAULT_MAX_HEADERS):
+        Proxy.__init__(self, get_proxy, server_host, server_port, backlog, chunk_size, max_head_size, max_headers)
         self.request_handler = request_handler
+        self.response_handler = response_handler
+
+    def _handler_conn(self, client_s: socket.socket):
+        return HandleCrackConn(client_s, self.get_proxy, self.request_handler, self.chunk_size,
+                               self.response_handler)
+
+
+class TlsProxy(Proxy):
+    def __init__(self, get_proxy, server_host="127.0.0.1", server_port=9443, backlog=DEFAULT_BACKLOG,
+                 chunk_size=DEFAULT_CHUNK_SIZE, sniff_timeout=5.0,
+                 max_head_size=DEFAULT_MAX_HEAD_SIZE, max_headers=DEFAULT_MAX_HEADERS):
+        """
+        按SNI转发https,get_proxy的第一个参数为ClientHello
+        """
+        Proxy.__init__(self, get_proxy, server_host, server_port, backlog, chunk_size, max_head_size, max_headers)
+        self.sniff_timeout = sniff_timeout
+
+    def _handler_conn(self, client_s: socket.socket):
+        return HandleTlsConn(client_s, self.get_proxy, self.chunk_size, self.sniff_timeout)
+
+
+class MuxProxy(TlsProxy):
+    def __init__(self, get_proxy, server_host="127.0.0.1", server_port=9999, backlog=DEFAULT_BACKLOG,
+                 chunk_size=DEFAULT_CHUNK_SIZE, sniff_timeout=5.0,
+                 max_head_size=DEFAULT_MAX_HEAD_SIZE, max_headers=DEFAULT_MAX_HEADERS):
+        """
+        一个端口同时转发http和https
+        """
+        TlsProxy.__init__(self, get_proxy, server_host, server_port, backlog, chunk_size, sniff_timeout,
+                          max_head_size, max_headers)
+
+    def _handler_conn(self, client_s: socket.socket):
+        return HandleMuxConn(client_s, self.get_proxy, self.chunk_size, self.sniff_timeout)
+
 
+class KeepAliveCrackProxy(CrackProxy):
     def _handler_conn(self, client_s: socket.socket):
-        return HandleCrackConn(client_s, self.get_proxy, self.request_handler)
+        return HandleKeepAliveCrackConn(client_s, self.get_proxy, self.request_handler, self.chunk_size,
+                                        self.response_handler)
 
 
 def gen_proxy(request: Request)->socket.socket:
-    print(request.method, request.uri, request.version, request.headers)
+    logger.debug("%s %s %s %s", request.method, request.uri, request.version, request.headers)
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     s.connect(("x.x.x.x", 80))
     return s
 
 
-def request_handler(request: Request) ->Request:
-    uri = request.uri
-    loc = uri.find("?")
-    if loc == -1:
-        request.uri = "/form"
-    else:
-        request.uri = "/form?%s" % uri[loc+1:]
-    return request
+# 所有请求的path改为/form, query不变
+request_handler = RuleSet([Rule(set_path="/form")])
 
 
 if __name__ == "__main__":
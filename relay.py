@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2019-09-24 22:48
+# @File    : relay.py
+
+import os
+import socket
+import selectors
+from shared import Conn, DEFAULT_CHUNK_SIZE, HAS_SPLICE, SPLICE_CHUNK_SIZE, SPLICE_UNSUPPORTED
+from metrics import record_error
+from log import logger
+
+
+class _Direction:
+    __slots__ = ("src", "dst", "buff", "view", "pipe", "start", "end", "eof", "copied")
+
+    def __init__(self, src: socket.socket, dst: socket.socket, buff: bytearray):
+        """
+        有splice时数据经过pipe在内核中转发,第一次splice就不支持时改用buff
+        """
+        self.src = src
+        self.dst = dst
+        self.buff = buff
+        self.view = memoryview(buff)
+        self.pipe = os.pipe() if HAS_SPLICE else None
+        # buff[start: end](或pipe中end-start个字节)为还没有发送出去的数据
+        self.start = 0
+        self.end = 0
+        self.eof = False
+        self.copied = 0
+
+    def pending(self)->bool:
+        return self.start < self.end
+
+    def want_read(self)->bool:
+        return not self.eof and not self.pending()
+
+    def _read(self)->int:
+        if self.pipe is not None:
+            try:
+                return os.splice(self.src.fileno(), self.pipe[1], SPLICE_CHUNK_SIZE, flags=os.SPLICE_F_NONBLOCK)
+            except OSError as e:
+                if self.copied > 0 or e.errno not in SPLICE_UNSUPPORTED:
+                    raise
+                self.close_pipe()
+        return self.src.recv_into(self.buff)
+
+    def _write(self)->int:
+        if self.pipe is not None:
+            return os.splice(self.pipe[0], self.dst.fileno(), self.end - self.start, flags=os.SPLICE_F_NONBLOCK)
+        return self.dst.send(self.view[self.start: self.end])
+
+    def close_pipe(self):
+        if self.pipe is not None:
+            os.close(self.pipe[0])
+            os.close(self.pipe[1])
+            self.pipe = None
+
+    def on_readable(self):
+        try:
+            n = self._read()
+        except BlockingIOError:
+            return
+        if n == 0:
+            self.eof = True
+            # 把半关闭传递给对端
+            try:
+                self.dst.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+            return
+        self.start, self.end = 0, n
+        self.on_writable()
+
+    def on_writable(self):
+        try:
+            n = self._write()
+        except BlockingIOError:
+            return
+        self.start += n
+        self.copied += n
+
+
+def _flush_buffered(src: Conn, dst: Conn, chunk_size: int)->int:
+    """
+    src中需要回放/改写的数据先用阻塞方式写入dst
+    """
+    copied = 0
+    buff = src.slab(chunk_size)
+    with memoryview(buff) as view:
+        while src.raw_socket() is None:
+            n = src.recv_into(buff)
+            if n == 0:
+                break
+            dst.sendall(view[: n])
+            copied += n
+    return copied
+
+
+def relay(a: Conn, b: Conn, idle_timeout: float = None, chunk_size=DEFAULT_CHUNK_SIZE)->(int, int):
+    """
+    在一个线程中用selectors双向转发a和b,一个方向读到EOF后shutdown(SHUT_WR)对端
+    两个方向都结束,或者超过idle_timeout秒没有任何数据时返回
+    回放的数据读完后a和b都必须能直接读写socket(raw_socket不为None)
+    有splice时socket之间的数据不经过用户态
+    :return: a->b的字节数, b->a的字节数
+    """
+    a_to_b = _flush_buffered(a, b, chunk_size)
+    b_to_a = _flush_buffered(b, a, chunk_size)
+    a_socket, b_socket = a.raw_socket(), b.raw_socket()
+    if a_socket is None or b_socket is None:
+        raise ValueError("relay needs raw sockets")
+
+    forward = _Direction(a_socket, b_socket, a.slab(chunk_size))
+    backward = _Direction(b_socket, a_socket, b.slab(chunk_size))
+    a_socket.setblocking(False)
+    b_socket.setblocking(False)
+
+    sel = selectors.DefaultSelector()
+    registered = dict()
+
+    def update(s: socket.socket, events: int):
+        old = registered.get(s, 0)
+        if events == old:
+            return
+        if old == 0:
+            sel.register(s, events)
+        elif events == 0:
+            sel.unregister(s)
+        else:
+            sel.modify(s, events)
+        registered[s] = events
+
+    try:
+        while not (forward.eof and backward.eof):
+            for s, d_read, d_write in ((a_socket, forward, backward), (b_socket, backward, forward)):
+                events = (selectors.EVENT_READ if d_read.want_read() else 0) | \
+                         (selectors.EVENT_WRITE if d_write.pending() else 0)
+                update(s, events)
+
+            ready = sel.select(idle_timeout)
+            if not ready:
+                logger.info("relay idle for %ss, closing", idle_timeout)
+                break
+            for key, mask in ready:
+                s = key.fileobj
+                d_read, d_write = (forward, backward) if s is a_socket else (backward, forward)
+                if mask & selectors.EVENT_WRITE and d_write.pending():
+                    d_write.on_writable()
+                if mask & selectors.EVENT_READ and d_read.want_read():
+                    d_read.on_readable()
+    except (ConnectionError, OSError) as e:
+        record_error("relay", e)
+        logger.info("relay broken cause: %s", e)
+    finally:
+        sel.close()
+        for d in (forward, backward):
+            d.view.release()
+            d.close_pipe()
+    return a_to_b + forward.copied, b_to_a + backward.copied
@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2019-10-06 15:30
+# @File    : rewrite.py
+
+import re
+from urllib.parse import parse_qsl, urlencode
+from http_request import Request
+from router import normalize_host
+
+
+# 合并正则时把规则中的命名分组换成普通分组,避免不同规则的分组重名
+_NAMED_GROUP = re.compile(r"\(\?P<\w+>")
+# 开头的全局flag, 合并时改为只作用于这个规则的(?flags:...)
+_GLOBAL_FLAGS = re.compile(r"^\(\?([aiLmsux]+)\)")
+# 引用分组的规则合并之后分组的序号和名字都变了,只能单独匹配
+_GROUP_REF = re.compile(r"\\[1-9]|\(\?P=|\(\?\(")
+# 每个合并正则中的规则数
+# 分组越多sre在每个分支失败时恢复分组的开销越大,规则很多时整体变为平方级
+REGEX_BLOCK_SIZE = 64
+
+
+def _segments(path: str)->list:
+    """
+    /api/v1/ -> ["api", "v1", ""]
+    """
+    return path.split("/")[1:]
+
+
+def _combinable(pattern: str)->str:
+    """
+    :return: 可以和其他规则合并的写法,不能合并时为None
+    """
+    if _GROUP_REF.search(pattern):
+        return None
+    pattern = _NAMED_GROUP.sub("(?:", pattern)
+    m = _GLOBAL_FLAGS.match(pattern)
+    if m is not None:
+        pattern = "(?%s:%s)" % (m.group(1), pattern[m.end():])
+    try:
+        re.compile("(?:%s)" % pattern)
+    except re.error:
+        return None
+    return pattern
+
+
+def split_uri(uri: str)->(str, str, str):
+    """
+    :return: (scheme://host部分, path, query) 没有query时为None
+    """
+    prefix = ""
+    if not uri.startswith("/"):
+        loc = uri.find("://")
+        if loc != -1:
+            loc = uri.find("/", loc + 3)
+            if loc == -1:
+                return uri, "/", None
+            prefix, uri = uri[: loc], uri[loc:]
+    path, sep, query = uri.partition("?")
+    return prefix, path, query if sep else None
+
+
+class Rule:
+    def __init__(self, host=None, method=None, path_prefix=None, path_regex=None, set_path=None,
+                 set_headers=None, add_headers=None, remove_headers=None, set_query=None, remove_query=None):
+        """
+        匹配条件都为None时匹配所有请求
+        :param host: Host头(不含端口)精确匹配
+        :param method: 请求方法或方法列表
+        :param path_prefix: 按路径段匹配前缀, /api 匹配/api和/api/x,不匹配/apix
+        :param path_regex: 从path开头匹配的正则, path已经过parse_request_line解码, 和path_prefix只能设置一个
+        :param set_path: 新的path, path_prefix规则只替换匹配的前缀,
+                         path_regex规则可以用\\1或\\g<name>引用分组
+        :param set_headers: {name: value} 替换同名的请求头
+        :param add_headers: {name: value} 或 [(name, value)] 追加请求头
+        :param remove_headers: [name] 删除请求头
+        :param set_query: {k: v} 设置query参数
+        :param remove_query: [k] 删除query参数
+        """
+        if path_prefix is not None and path_regex is not None:
+            raise ValueError("path_prefix and path_regex cant be both set")
+        self.host = normalize_host(host) if host else None
+        if isinstance(method, str):
+            method = [method]
+        self.methods = [m.upper() for m in method] if method else None
+        self.path_prefix = path_prefix
+        self.prefix_segments = None
+        if path_prefix is not None:
+            # 结尾的/不影响匹配
+            self.prefix_segments = [s for s in _segments("/" + path_prefix.strip("/")) if s]
+        self.path_regex = re.compile(path_regex) if path_regex is not None else None
+        self.set_path = set_path
+        self.set_headers = dict(set_headers or {})
+        if isinstance(add_headers, dict):
+            add_headers = add_headers.items()
+        self.add_headers = list(add_headers or [])
+        self.remove_headers = list(remove_headers or [])
+        self.set_query = dict(set_query or {})
+        self.remove_query = list(remove_query or [])
+
+    @classmethod
+    def from_dict(cls, d: dict)->"Rule":
+        return cls(**d)
+
+    def _new_path(self, path: str, match)->str:
+        if self.set_path is None:
+            return path
+        if match is not None:
+            return match.expand(self.set_path)
+        if self.prefix_segments is not None:
+            rest = _segments(path)[len(self.prefix_segments):]
+            if rest:
+                return self.set_path.rstrip("/") + "/" + "/".join(rest)
+        return self.set_path
+
+    def _new_query(self, query: str)->str:
+        if not self.set_query and not self.remove_query:
+            return query
+        params = parse_qsl(query or "", keep_blank_values=True)
+        removed = set(self.remove_query) | set(self.set_query)
+        params = [(k, v) for k, v in params if k not in removed]
+        params.extend((k, str(v)) for k, v in self.set_query.items())
+        return urlencode(params)
+
+    def apply(self, req: Request, match=None)->Request:
+        """
+        :param match: path_regex规则匹配path的结果
+        """
+        if self.set_path is not None or self.set_query or self.remove_query:
+            prefix, path, query = split_uri(req.uri)
+            path, sep, path_query = self._new_path(path, match).partition("?")
+            if sep:
+                # set_path中带的query放在原来的query前面
+                query = path_query + "&" + query if query else path_query
+            query = self._new_query(query)
+            req.uri = prefix + path + ("?" + query if query else "")
+        for name in self.remove_headers:
+            req.remove_header(name)
+        for name, value in self.set_headers.items():
+            req.set_header(name, value)
+        for name, value in self.add_headers:
+            req.add_header(name, value)
+        return req
+
+    def __repr__(self):
+        return "Rule(host=%s, method=%s, path_prefix=%s, path_regex=%s)" % (
+            self.host, self.methods, self.path_prefix, self.path_regex and self.path_regex.pattern)
+
+
+class _PrefixNode:
+    __slots__ = ("children", "rule")
+
+    def __init__(self):
+        self.children = dict()
+        # 前缀到这里结束的规则中最靠前的序号
+        self.rule = None
+
+
+class _Table:
+    def __init__(self):
+        """
+        host和method条件都相同的规则
+        前缀规则放入按路径段的trie, 相邻的正则规则每REGEX_BLOCK_SIZE个合并为一个正则
+        有全局flag以外的原因不能合并的正则规则单独匹配
+        """
+        self.root = _PrefixNode()
+        self.has_prefix = False
+        # 没有path条件的规则中最靠前的序号
+        self.catch_all = None
+        self.regex_rules = []
+        # [(第一个规则的序号, 判断是否匹配的正则, 带分组找出规则的正则)] 单独匹配的规则没有第三项
+        self.regex_blocks = []
+
+    def add(self, i: int, rule: Rule):
+        if rule.prefix_segments is not None:
+            node = self.root
+            for seg in rule.prefix_segments:
+                node = node.children.setdefault(seg, _PrefixNode())
+            if node.rule is None:
+                node.rule = i
+            self.has_prefix = True
+        elif rule.path_regex is not None:
+            self.regex_rules.append((i, rule.path_regex))
+        elif self.catch_all is None:
+            self.catch_all = i
+
+    def _add_block(self, block: list):
+        # re.match对分支按顺序尝试,第一个匹配的分支就是最靠前的规则
+        any_regex = re.compile("|".join("(?:%s)" % pattern for _, pattern in block))
+        regex = re.compile("|".join("(?P<r%d>%s)" % (i, pattern) for i, pattern in block))
+        self.regex_blocks.append((block[0][0], any_regex, regex))
+
+    def compile(self):
+        block = []
+        for i, path_regex in self.regex_rules:
+            pattern = _combinable(path_regex.pattern)
+            if pattern is not None:
+                block.append((i, pattern))
+                if len(block) == REGEX_BLOCK_SIZE:
+                    self._add_block(block)
+                    block = []
+                continue
+            if block:
+                self._add_block(block)
+                block = []
+            self.regex_blocks.append((i, path_regex, None))
+        if block:
+            self._add_block(block)
+
+    def match(self, path: str, segments: list)->int:
+        """
+        :return: 匹配的规则中最靠前的序号,没有则为None
+        """
+        best = self.catch_all
+        if self.has_prefix:
+            node = self.root
+            if node.rule is not None and (best is None or node.rule < best):
+                best = node.rule
+            for seg in segments:
+                node = node.children.get(seg)
+                if node is None:
+                    break
+                if node.rule is not None and (best is None or node.rule < best):
+                    best = node.rule
+        for first, any_regex, regex in self.regex_blocks:
+            if best is not None and first > best:
+                break
+            if any_regex.match(path) is not None:
+                i = int(regex.match(path).lastgroup[1:]) if regex is not None else first
+                if best is None or i < best:
+                    best = i
+                break
+        return best
+
+
+class RuleSet:
+    def __init__(self, rules: list):
+        """
+        声明式的请求改写规则,创建时编译,只使用第一个匹配的规则
+        按(host, method)分组,每组的前缀规则为一个trie,正则规则为几个合并的正则
+        每个请求最多查找4组,前缀规则的开销只和path的段数有关
+        可以直接作为request_handler
+        :param rules: Rule或者Rule参数的dict
+        """
+        self.rules = [r if isinstance(r, Rule) else Rule.from_dict(r) for r in rules]
+        self._tables = dict()
+        for i, rule in enumerate(self.rules):
+            for method in rule.methods or [None]:
+                key = (rule.host, method)
+                table = self._tables.get(key)
+                if table is None:
+                    table = self._tables[key] = _Table()
+                table.add(i, rule)
+        for table in self._tables.values():
+            table.compile()
+
+    def __len__(self)->int:
+        return len(self.rules)
+
+    def match(self, req: Request)->Rule:
+        host = normalize_host(req.header("Host"))
+        method = req.method
+        _, path, _ = split_uri(req.uri)
+        segments = None
+        best = None
+        for key in ((host, method), (host, None), (None, method), (None, None)):
+            table = self._tables.get(key)
+            if table is None:
+                continue
+            if segments is None:
+                segments = _segments(path)
+            i = table.match(path, segments)
+            if i is not None and (best is None or i < best):
+                best = i
+        return self.rules[best] if best is not None else None
+
+    def __call__(self, req: Request)->Request:
+        rule = self.match(req)
+        if rule is None:
+            return req
+        match = None
+        if rule.path_regex is not None and rule.set_path is not None:
+            match = rule.path_regex.match(split_uri(req.uri)[1])
+        return rule.apply(req, match)
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2019-09-05 22:31
+# @File    : router.py
+
+import time
+import socket
+from tls import ClientHello
+from upstream import UpstreamPools
+from balancer import Backend, HealthChecker, new_balancer, BALANCE_ROUND_ROBIN, BALANCE_HASH_IP, \
+    BALANCE_HASH_HOST
+
+
+# VhostRouter创建的BackendPool的连接超时(秒)
+DEFAULT_CONNECT_TIMEOUT = 5.0
+
+
+def parse_addr(addr)->(str, int):
+    """
+    "host:port" 或 (host, port)
+    """
+    if isinstance(addr, tuple):
+        return addr[0], int(addr[1])
+    host, _, port = addr.rpartition(":")
+    if not host:
+        raise ValueError("invalid backend address: %s" % addr)
+    return host.strip("[]"), int(port)
+
+
+def normalize_host(host: str)->str:
+    """
+    去掉端口号和结尾的点,转换为小写
+    example.com:8080 -> example.com
+    [::1]:8080 -> ::1
+    """
+    if not host:
+        return ""
+    host = host.strip().lower()
+    if host.startswith("["):
+        loc = host.find("]")
+        return host[1: loc] if loc != -1 else host[1:]
+    loc = host.rfind(":")
+    if loc != -1:
+        host = host[: loc]
+    return host.rstrip(".")
+
+
+def route_host(info)->str:
+    """
+    get_proxy参数中的host,Request为Host头,ClientHello为SNI
+    """
+    if isinstance(info, ClientHello):
+        return normalize_host(info.server_name)
+    return normalize_host(info.header("Host"))
+
+
+class BackendPool:
+    def __init__(self, addrs, connect_timeout=None, upstream: UpstreamPools = None, balance=BALANCE_ROUND_ROBIN,
+                 max_fails=1, eject_time=10.0):
+        """
+        一个vhost对应的后端地址集合,按balance选择后端
+        不可用(健康检查失败或者被摘除)的后端会被跳过,连接失败时尝试下一个
+        :param addrs: 单个地址或地址列表,地址为"host:port"或(host, port)
+        :param connect_timeout: 连接超时时间(秒)
+        :param upstream: 连接池,设置了则从连接池中获取(预热的)连接
+        :param balance: BALANCE_ROUND_ROBIN/BALANCE_LEAST_CONN/BALANCE_HASH_IP/BALANCE_HASH_HOST
+        :param max_fails: 连续连接失败多少次之后摘除
+        :param eject_time: 摘除的时间(秒)
+        """
+        if isinstance(addrs, (str, tuple)):
+            addrs = [addrs]
+        self.addrs = [parse_addr(addr) for addr in addrs]
+        if len(self.addrs) == 0:
+            raise ValueError("backend pool cant be empty")
+        self.connect_timeout = connect_timeout
+        self.upstream = upstream
+        self.balance = balance
+        self.backends = [Backend(addr, max_fails, eject_time) for addr in self.addrs]
+        self._balancer = new_balancer(balance, self.backends)
+        if upstream is not None:
+            upstream.attach(self, self.addrs)
+
+    def close(self):
+        """
+        不再使用这个BackendPool, 其他BackendPool没有用到的后端的连接池随之关闭
+        """
+        if self.upstream is not None:
+            self.upstream.detach(self)
+
+    def hash_key(self, info)->str:
+        """
+        一致性hash的key, info为get_proxy的参数(Request或者ClientHello)
+        """
+        if info is None:
+            return None
+        if self.balance == BALANCE_HASH_IP:
+            remote_addr = getattr(info, "remote_addr", None)
+            return remote_addr[0] if remote_addr else None
+        if self.balance == BALANCE_HASH_HOST:
+            return route_host(info)
+        return None
+
+    def candidates(self, info=None)->list:
+        """
+        按优先顺序排列的可用后端,都不可用时返回所有后端
+        """
+        backends = self._balancer.order(self.hash_key(info))
+        now = time.monotonic()
+        available = [b for b in backends if b.available(now)]
+        return available or backends
+
+    def next_addr(self)->(str, int):
+        return self.candidates()[0].addr
+
+    def _connect(self, addr: (str, int))->socket.socket:
+        if self.upstream is not None:
+            return self.upstream.get(addr, self.connect_timeout)
+        s = socket.create_connection(addr, timeout=self.connect_timeout)
+        # 连接建立后转发阶段使用阻塞模式
+        s.settimeout(None)
+        return s
+
+    def connect(self, info=None)->socket.socket:
+        error = None
+        for backend in self.candidates(info):
+            try:
+                s = self._connect(backend.addr)
+            except OSError as e:
+                backend.on_failure(e)
+                error = e
+                continue
+            backend.on_success()
+            return backend.acquire(s)
+        raise error
+
+
+class _LabelNode:
+    __slots__ = ("children", "wildcard", "suffix")
+
+    def __init__(self):
+        self.children = dict()
+        # *.example.com 匹配所有子域名,不包括example.com本身
+        self.wildcard = None
+        # .example.com 匹配example.com及所有子域名
+        self.suffix = None
+
+
+class VhostRouter:
+    def __init__(self, default=None, upstream: UpstreamPools = None, health_checker: HealthChecker = None,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT):
+        """
+        根据host找到对应的后端
+        精确匹配用dict,通配符和后缀匹配用按label倒序的trie,查找时间只和host的label个数有关
+        可以直接作为Proxy的get_proxy
+        :param default: 都没有匹配到时使用的后端
+        :param upstream: 用地址创建的BackendPool都使用这个连接池
+        :param health_checker: 所有BackendPool的后端都加入这个健康检查
+        :param connect_timeout: 用地址创建的BackendPool的连接超时(秒),使用upstream时也用于新建连接
+        """
+        self.upstream = upstream
+        self.health_checker = health_checker
+        self.connect_timeout = connect_timeout
+        self._exact = dict()
+        self._trie = _LabelNode()
+        self.default = self._pool(default) if default is not None else None
+
+    def _pool(self, backends, balance=BALANCE_ROUND_ROBIN)->BackendPool:
+        if not isinstance(backends, BackendPool):
+            backends = BackendPool(backends, self.connect_timeout, self.upstream, balance)
+        if self.health_checker is not None:
+            self.health_checker.add(backends.backends)
+        return backends
+
+    def add(self, pattern: str, backends, balance=BALANCE_ROUND_ROBIN):
+        """
+        :param pattern: example.com 精确匹配, *.example.com 通配符, .example.com 后缀, * 默认
+        :param backends: BackendPool或地址(列表)
+        :param balance: backends为地址时使用的负载均衡方式
+        """
+        pool = self._pool(backends, balance)
+        pattern = pattern.strip().lower().rstrip(".")
+        if pattern == "*":
+            self.default = pool
+            return
+
+        if pattern.startswith("*."):
+            kind, name = "wildcard", pattern[2:]
+        elif pattern.startswith("."):
+            kind, name = "suffix", pattern[1:]
+        else:
+            self._exact[pattern] = pool
+            return
+
+        node = self._trie
+        for label in reversed(name.split(".")):
+            node = node.children.setdefault(label, _LabelNode())
+        setattr(node, kind, pool)
+
+    def pools(self)->list:
+        """
+        所有的BackendPool,包括默认的
+        """
+        pools = list(self._exact.values())
+        nodes = [self._trie]
+        while nodes:
+            node = nodes.pop()
+            for pool in (node.wildcard, node.suffix):
+                if pool is not None:
+                    pools.append(pool)
+            nodes.extend(node.children.values())
+        if self.default is not None:
+            pools.append(self.default)
+        return pools
+
+    def close(self):
+        for pool in self.pools():
+            pool.close()
+
+    def lookup(self, host: str)->BackendPool:
+        """
+        精确匹配优先,其次是最长的通配符/后缀匹配,最后是默认
+        """
+        host = normalize_host(host)
+        pool = self._exact.get(host)
+        if pool is not None:
+            return pool
+
+        best = None
+        labels = host.split(".") if host else []
+        node = self._trie
+        for i in range(len(labels) - 1, -1, -1):
+            node = node.children.get(labels[i])
+            if node is None:
+                break
+            if i == 0:
+                # 所有label都匹配完了,只有后缀规则包括域名本身
+                if node.suffix is not None:
+                    best = node.suffix
+            elif node.wildcard is not None or node.suffix is not None:
+                best = node.wildcard if node.wildcard is not None else node.suffix
+        return best if best is not None else self.default
+
+    def connect(self, host: str, info=None)->socket.socket:
+        pool = self.lookup(host)
+        if pool is None:
+            return None
+        return pool.connect(info)
+
+    def __call__(self, request)->socket.socket:
+        """
+        :param request: Request或者ClientHello(tls)
+        """
+        return self.connect(route_host(request), request)
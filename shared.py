@@ -1,5 +1,17 @@
 # -*- coding: utf-8 -*-
+import os
+import errno
 import socket
+import threading
+
+
+# splice只有linux上有(python3.10+)
+HAS_SPLICE = hasattr(os, "splice")
+SPLICE_CHUNK_SIZE = 65536
+# splice不支持这种fd时的errno
+SPLICE_UNSUPPORTED = (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP)
+# 默认每次读取的字节数
+DEFAULT_CHUNK_SIZE = 16384
 
 
 class EOF(Exception):
@@ -10,6 +22,14 @@ class Reader:
     def read(self, chunk_size)->bytes:
         pass
 
+    def read_into(self, buff)->int:
+        """
+        读取数据写入buff,返回读取的字节数
+        """
+        chunk = self.read(len(buff))
+        buff[: len(chunk)] = chunk
+        return len(chunk)
+
 
 class Writer:
     def write(self, bs: bytes)->int:
@@ -20,6 +40,33 @@ class ReaderWriter(Reader, Writer):
     pass
 
 
+class BufferPool:
+    def __init__(self, max_free=256):
+        """
+        复用bytearray,避免每个连接/每次读取都分配新的内存
+        :param max_free: 每种大小最多缓存的空闲buffer个数
+        """
+        self._free = dict()
+        self._max_free = max_free
+        self._lock = threading.Lock()
+
+    def get(self, size=DEFAULT_CHUNK_SIZE)->bytearray:
+        with self._lock:
+            slabs = self._free.get(size)
+            if slabs:
+                return slabs.pop()
+        return bytearray(size)
+
+    def put(self, slab: bytearray):
+        with self._lock:
+            slabs = self._free.setdefault(len(slab), [])
+            if len(slabs) < self._max_free:
+                slabs.append(slab)
+
+
+buffer_pool = BufferPool()
+
+
 class SocketRW(Reader, Writer):
     def __init__(self, _socket: socket.socket):
         self._socket = _socket
@@ -30,24 +77,43 @@ class SocketRW(Reader, Writer):
             raise EOF
         return chunk
 
+    def read_into(self, buff)->int:
+        n = self._socket.recv_into(buff)
+        if n == 0:
+            raise EOF
+        return n
+
     def write(self, bs: bytes)->int:
-        while len(bs) > 0:
-            n = self._socket.send(bs)
-            bs = bs[n:]
-        return len(bs)
+        written = 0
+        with memoryview(bs) as view:
+            while written < len(view):
+                written += self._socket.send(view[written:])
+        return written
 
 
 class Conn(ReaderWriter):
     def __init__(self, _socket: socket.socket):
         self._socket = _socket
+        self._slab = None
 
     @property
     def socket(self):
         return self._socket
 
+    def slab(self, size=DEFAULT_CHUNK_SIZE)->bytearray:
+        """
+        连接读数据用的buffer,从buffer_pool中获取,close时归还
+        """
+        if self._slab is None:
+            self._slab = buffer_pool.get(size)
+        return self._slab
+
     def recv(self, buff_size: int, flags: int = 0):
         return self._socket.recv(buff_size, flags)
 
+    def recv_into(self, buff, nbytes: int = 0, flags: int = 0)->int:
+        return self._socket.recv_into(buff, nbytes, flags)
+
     def send(self, data: bytes, flags: int = 0):
         return self._socket.send(data, flags)
 
@@ -61,8 +127,18 @@ class Conn(ReaderWriter):
         return self._socket.shutdown(how)
 
     def close(self):
+        if self._slab is not None:
+            buffer_pool.put(self._slab)
+            self._slab = None
         return self._socket.close()
 
+    def raw_socket(self):
+        """
+        剩余的数据流是否可以直接从socket读写(没有需要回放或改写的数据)
+        可以则返回socket,否则返回None
+        """
+        return self._socket
+
     def read(self, chunk_size)->bytes:
         return self.recv(chunk_size)
 
@@ -72,18 +148,28 @@ class Conn(ReaderWriter):
 
 class Buffer(Reader, Writer):
     def __init__(self, init_bytes=b""):
-        self._buff = init_bytes
+        # bytearray从头部删除不需要移动剩余数据
+        self._buff = bytearray(init_bytes)
 
     def len(self):
         return len(self._buff)
 
-    def read(self, chunk_size=1024):
+    def read(self, chunk_size=DEFAULT_CHUNK_SIZE):
         if len(self._buff) == 0:
             raise EOF
-        chunk = self._buff[: chunk_size]
-        self._buff = self._buff[chunk_size:]
+        chunk = bytes(self._buff[: chunk_size])
+        del self._buff[: chunk_size]
         return chunk
 
+    def read_into(self, buff, nbytes: int = 0)->int:
+        if len(self._buff) == 0:
+            raise EOF
+        n = min(len(self._buff), nbytes or len(buff))
+        with memoryview(buff) as dst, memoryview(self._buff) as src:
+            dst[: n] = src[: n]
+        del self._buff[: n]
+        return n
+
     def write(self, bs: bytes):
         self._buff += bs
 
@@ -91,7 +177,7 @@ class Buffer(Reader, Writer):
         self._buff += s.encode(encoding=encoding)
 
     def bytes(self):
-        return self._buff
+        return bytes(self._buff)
 
 
 class TeeReader(Reader):
@@ -106,6 +192,44 @@ class TeeReader(Reader):
         self.writer.write(chunk)
         return chunk
 
+    def read_into(self, buff)->int:
+        n = self.reader.read_into(buff)
+        if n == 0:
+            raise EOF
+        with memoryview(buff) as view:
+            self.writer.write(view[: n])
+        return n
+
+
+class MultiReader(Reader):
+    def __init__(self, *readers: Reader):
+        """
+        依次从多个reader中读取,前一个读到EOF后再读下一个
+        """
+        self._readers = list(readers)
+
+    def read(self, chunk_size)->bytes:
+        while len(self._readers) > 0:
+            try:
+                chunk = self._readers[0].read(chunk_size)
+            except EOF:
+                chunk = b""
+            if chunk:
+                return chunk
+            self._readers.pop(0)
+        raise EOF
+
+    def read_into(self, buff)->int:
+        while len(self._readers) > 0:
+            try:
+                n = self._readers[0].read_into(buff)
+            except EOF:
+                n = 0
+            if n > 0:
+                return n
+            self._readers.pop(0)
+        raise EOF
+
 
 class SharedConn(Conn):
     def __init__(self, _socket: socket.socket, v_buff: Buffer):
@@ -126,19 +250,48 @@ class SharedConn(Conn):
 
         return read
 
+    def recv_into(self, buff, nbytes: int = 0, flags: int = 0)->int:
+        if self._v_buff is None:
+            return self._socket.recv_into(buff, nbytes, flags)
+
+        try:
+            return self._v_buff.read_into(buff, nbytes)
+        except EOF:
+            self._v_buff = None
+            return self._socket.recv_into(buff, nbytes, flags)
+
+    def raw_socket(self):
+        # 回放buffer读完之后就是原始的socket数据
+        if self._v_buff is None or self._v_buff.len() == 0:
+            return self._socket
+        return None
+
 
 class BufferReader:
-    def __init__(self, reader: Reader, chunk_size=1024):
-            self._reader = reader
-            self._buffer = b""
-            self._search_loc = 0
-            self._chunk_size = chunk_size
+    def __init__(self, reader: Reader, chunk_size=DEFAULT_CHUNK_SIZE):
+        self._reader = reader
+        self._buffer = bytearray()
+        self._search_loc = 0
+        self._chunk_size = chunk_size
+        # 从reader读取时复用的buffer
+        self._slab = None
 
     def _fill(self):
-        bulk = self._reader.read(self._chunk_size)
-        if not bulk:
+        if self._slab is None:
+            self._slab = buffer_pool.get(self._chunk_size)
+        n = self._reader.read_into(self._slab)
+        if not n:
             raise EOF
-        self._buffer += bulk
+        with memoryview(self._slab) as view:
+            self._buffer += view[: n]
+
+    def release(self):
+        """
+        归还读取用的buffer,已经缓存的数据不受影响
+        """
+        if self._slab is not None:
+            buffer_pool.put(self._slab)
+            self._slab = None
 
     def read_line(self, encoding="utf-8") -> str:
         """
@@ -169,11 +322,50 @@ class BufferReader:
             loc = self._search(delimiter)
 
         # 找到了
-        res = self._buffer[:loc + 1]
-        self._buffer = self._buffer[loc + 1:]
+        res = bytes(self._buffer[:loc + 1])
+        del self._buffer[:loc + 1]
         self._search_loc = 0
         return res
 
+    def buffered(self)->int:
+        """
+        已经读取到缓存中还没有被取走的字节数
+        """
+        return len(self._buffer)
+
+    def wait_data(self):
+        """
+        缓存中没有数据时从reader读取一次,reader已经结束时抛出EOF
+        """
+        if len(self._buffer) == 0:
+            self._fill()
+
+    def read_some(self, n: int)->bytes:
+        """
+        最多读取n个字节,缓存中没有数据时才从reader中读取一次
+        :return:
+        """
+        if len(self._buffer) == 0:
+            self._fill()
+        chunk = bytes(self._buffer[: n])
+        del self._buffer[: n]
+        return chunk
+
+    def read_into(self, buff, n: int)->int:
+        """
+        最多读取n个字节到buff中
+        缓存中有数据时只从缓存中取,否则直接从reader读取到buff,不经过缓存
+        :return: 读取的字节数
+        """
+        n = min(n, len(buff))
+        if len(self._buffer) > 0:
+            n = min(n, len(self._buffer))
+            buff[: n] = self._buffer[: n]
+            del self._buffer[: n]
+            return n
+        with memoryview(buff) as view:
+            return self._reader.read_into(view[: n])
+
     def read_until_n(self, n: int)->bytes:
         """
         一共直到读取n个字节
@@ -182,8 +374,8 @@ class BufferReader:
         """
         while len(self._buffer) < n:
             self._fill()
-        chunk = self._buffer[: n]
-        self._buffer = self._buffer[n:]
+        chunk = bytes(self._buffer[: n])
+        del self._buffer[: n]
         return chunk
 
 
@@ -195,22 +387,85 @@ def new_shared_conn(s: socket.socket) ->(Buffer, TeeReader):
     return v_buff, tee
 
 
-def io_copy(src: Conn, target: Conn, r_flags=0, s_flags=0)->int:
+def _splice_copy(src: socket.socket, target: socket.socket, chunk_size=SPLICE_CHUNK_SIZE)->int:
+    """
+    通过pipe用splice在两个socket之间拷贝数据,数据不经过用户态
+    第一次splice就不支持时抛出NotImplementedError,由调用方回退到recv_into
+    """
+    r_fd, w_fd = os.pipe()
+    copied = 0
+    try:
+        while True:
+            try:
+                n = os.splice(src.fileno(), w_fd, chunk_size)
+            except OSError as e:
+                if copied == 0 and e.errno in SPLICE_UNSUPPORTED:
+                    raise NotImplementedError(e)
+                raise
+            if n == 0:
+                return copied
+            while n > 0:
+                m = os.splice(r_fd, target.fileno(), n)
+                n -= m
+                copied += m
+    finally:
+        os.close(r_fd)
+        os.close(w_fd)
+
+
+def _recv_into_copy(src: socket.socket, target: socket.socket, buff: bytearray)->int:
+    """
+    使用一块复用的buffer在两个socket之间拷贝数据
+    """
+    copied = 0
+    with memoryview(buff) as view:
+        while True:
+            n = src.recv_into(buff)
+            if n == 0:
+                return copied
+            target.sendall(view[: n])
+            copied += n
+
+
+def raw_copy(src: socket.socket, target: socket.socket, buff: bytearray = None)->int:
+    """
+    两个socket之间的原始数据拷贝,优先使用splice
+    只支持阻塞(没有设置timeout)的socket
+    """
+    if HAS_SPLICE:
+        try:
+            return _splice_copy(src, target)
+        except NotImplementedError:
+            pass
+    return _recv_into_copy(src, target, buff if buff is not None else bytearray(DEFAULT_CHUNK_SIZE))
+
+
+def io_copy(src: Conn, target: Conn, r_flags=0, s_flags=0, chunk_size=DEFAULT_CHUNK_SIZE)->int:
     """
     从src中读取数据并放入到target中,返回一共读取的字节数
+    src中需要回放/改写的数据读完以后,剩余的数据直接在socket之间拷贝
     :param src:
     :param target:
     :param r_flags:
     :param s_flags:
+    :param chunk_size: 每次读取的字节数
     :return:
     """
     copied = 0
-
-    while True:
-        chunk = src.recv(1024, flags=r_flags)
-        if not chunk:
-            return copied
-        while chunk:
-            n = target.send(chunk, flags=s_flags)
+    buff = src.slab(chunk_size)
+
+    with memoryview(buff) as view:
+        while True:
+            if r_flags == 0 and s_flags == 0:
+                src_socket, target_socket = src.raw_socket(), target.raw_socket()
+                if src_socket is not None and target_socket is not None \
+                        and src_socket.gettimeout() is None and target_socket.gettimeout() is None:
+                    return copied + raw_copy(src_socket, target_socket, buff)
+
+            n = src.recv_into(buff, 0, r_flags)
+            if n == 0:
+                return copied
+            sent = 0
+            while sent < n:
+                sent += target.send(view[sent: n], s_flags)
             copied += n
-            chunk = chunk[n:]
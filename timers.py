@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2019-10-05 20:12
+# @File    : timers.py
+
+import os
+import time
+import socket
+import threading
+from log import logger
+
+
+# 时间轮每一格的时间(秒)
+DEFAULT_TICK = 0.1
+# 时间轮的格数, 超过一圈的定时器记录还要转几圈
+DEFAULT_SLOTS = 512
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Timer:
+    __slots__ = ("callback", "rounds", "slot", "fired", "cancelled")
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.rounds = 0
+        self.slot = None
+        self.fired = False
+        self.cancelled = False
+
+
+class TimerWheel:
+    def __init__(self, tick=DEFAULT_TICK, slots=DEFAULT_SLOTS):
+        """
+        所有连接共用的时间轮,只有一个线程
+        定时器的精度为tick秒,添加和取消都是O(1)
+        回调在时间轮的线程中执行,必须很快返回(例如关闭socket)
+        """
+        self.tick = tick
+        self._slots = [set() for _ in range(slots)]
+        self._cursor = 0
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _ensure_started(self):
+        # fork之后子进程中需要重新启动线程
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            t = threading.Thread(target=self._run)
+            t.setDaemon(True)
+            t.start()
+            self._pid = os.getpid()
+
+    def schedule(self, delay: float, callback)->Timer:
+        """
+        delay秒后调用callback()
+        """
+        self._ensure_started()
+        timer = Timer(callback)
+        ticks = max(1, int(-(-delay // self.tick)))
+        n = len(self._slots)
+        with self._lock:
+            timer.rounds = (ticks - 1) // n
+            timer.slot = (self._cursor + ticks) % n
+            self._slots[timer.slot].add(timer)
+        return timer
+
+    def cancel(self, timer: Timer):
+        with self._lock:
+            timer.cancelled = True
+            if timer.slot is not None:
+                self._slots[timer.slot].discard(timer)
+                timer.slot = None
+
+    def _advance(self)->list:
+        with self._lock:
+            self._cursor = (self._cursor + 1) % len(self._slots)
+            slot = self._slots[self._cursor]
+            due = [t for t in slot if t.rounds == 0]
+            for t in slot:
+                t.rounds -= 1
+            for t in due:
+                slot.discard(t)
+                t.slot = None
+                t.fired = True
+        return due
+
+    def _run(self):
+        next_tick = time.monotonic() + self.tick
+        while True:
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            next_tick += self.tick
+            for timer in self._advance():
+                try:
+                    timer.callback()
+                except Exception as e:
+                    logger.error("timer callback failed cause: %s", e)
+
+
+wheel = TimerWheel()
+
+
+def abort_socket(s: socket.socket):
+    """
+    让阻塞在这个socket上的读写立即返回
+    """
+    try:
+        s.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+class Deadline:
+    def __init__(self, timeout: float, sockets, _wheel: TimerWheel = None):
+        """
+        with Deadline(timeout, [s]) as d: ...
+        超时时shutdown所有socket, 阻塞的读写会返回EOF/出错, 退出with时抛出DeadlineExceeded
+        timeout为None时不做任何事
+        """
+        self.timeout = timeout
+        self.sockets = sockets
+        self._wheel = _wheel or wheel
+        self._timer = None
+
+    @property
+    def exceeded(self)->bool:
+        return self._timer is not None and self._timer.fired
+
+    def _expire(self):
+        for s in self.sockets:
+            abort_socket(s)
+
+    def __enter__(self):
+        if self.timeout is not None:
+            self._timer = self._wheel.schedule(self.timeout, self._expire)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._timer is None:
+            return False
+        self._wheel.cancel(self._timer)
+        if self._timer.fired:
+            raise DeadlineExceeded("deadline of %ss exceeded" % self.timeout) from exc
+        return False
+
+
+class IdleWatchdog:
+    def __init__(self, timeout: float, on_idle, _wheel: TimerWheel = None):
+        """
+        超过timeout秒没有调用touch()时调用on_idle()
+        每个周期只有一个定时器,touch只记录时间
+        """
+        self.timeout = timeout
+        self.on_idle = on_idle
+        self.last = time.monotonic()
+        self.idle = False
+        self._wheel = _wheel or wheel
+        self._timer = None
+        self._stopped = False
+
+    def touch(self):
+        self.last = time.monotonic()
+
+    def _check(self):
+        if self._stopped:
+            return
+        remain = self.timeout - (time.monotonic() - self.last)
+        if remain > 0:
+            self._timer = self._wheel.schedule(remain, self._check)
+            return
+        self.idle = True
+        self.on_idle()
+
+    def start(self):
+        if self.timeout is None:
+            return self
+        self.touch()
+        self._timer = self._wheel.schedule(self.timeout, self._check)
+        return self
+
+    def stop(self):
+        self._stopped = True
+        if self._timer is not None:
+            self._wheel.cancel(self._timer)
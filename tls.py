@@ -1,38 +1,29 @@
 # -*- coding: utf-8 -*-
 import socket
-from shared import SharedConn, Buffer, EOF, Reader, BufferReader, SocketRW, new_shared_conn
+import struct
+from shared import SharedConn, Buffer, Reader, BufferReader, new_shared_conn
 
 
-def bytes_to_int(chunk: bytes) ->int:
-    if len(chunk) == 0:
-        raise ValueError("chunk cant be empty")
-    num = 0
-    for b in chunk:
-        num <<= 8
-        num |= b
-    return num
+# record header: content type 1 bytes, version 2 bytes, length 2 bytes
+RECORD_HEADER = struct.Struct("!BHH")
+CONTENT_TYPE_HANDSHAKE = 0x16
+HANDSHAKE_CLIENT_HELLO = 0x01
+# clientHello最多可以分成多个record,总长度不超过这个值
+MAX_HANDSHAKE_LENGTH = 65536
 
+EXT_SERVER_NAME = 0x0000
+EXT_ALPN = 0x0010
+EXT_SUPPORTED_VERSIONS = 0x002b
 
-class Consumer:
-    def __init__(self, init_bytes=b""):
-        self._buff = init_bytes
 
-    def len(self):
-        return len(self._buff)
-
-    def consume(self, n)->bytes:
-        if len(self._buff) < n:
-            raise EOF
-        c = self._buff[: n]
-        self._buff = self._buff[n:]
-        return c
+class ClientHelloError(Exception):
+    pass
 
-    def consume_int(self, n)->int:
-        chunk = self.consume(n)
-        return bytes_to_int(chunk)
 
-    def write(self, chunk: bytes):
-        self._buff += chunk
+def bytes_to_int(chunk: bytes) ->int:
+    if len(chunk) == 0:
+        raise ValueError("chunk cant be empty")
+    return int.from_bytes(chunk, "big")
 
 
 class ClientHello:
@@ -41,7 +32,7 @@ class ClientHello:
         self.content_type = 0
         # tls version 2 bytes
         self.version = 0
-        # tls length 2 bytes
+        # tls length 2 bytes, clientHello跨多个record时为第一个record的长度
         self.length = 0
 
         # handshake type 1 bytes
@@ -78,56 +69,135 @@ class ClientHello:
         # data length bytes
         self.server_name = ""
 
+        # alpn 扩展 Type 0x0010
+        # ListLength 2 bytes, 每个协议为 length 1 bytes + name
+        self.alpn = []
+
+        # supported_versions 扩展 Type 0x002b
+        # ListLength 1 bytes, 每个版本2 bytes
+        self.supported_versions = []
+
+        # 客户端地址,不是clientHello中的内容,转发时设置
+        self.remote_addr = None
+
+
+def _read_handshake(bf: BufferReader, client_hello: ClientHello)->memoryview:
+    """
+    读取完整的clientHello handshake消息,可能跨越多个record
+    """
+    header = bf.read_until_n(RECORD_HEADER.size)
+    client_hello.content_type, client_hello.version, client_hello.length = RECORD_HEADER.unpack(header)
+    if client_hello.content_type != CONTENT_TYPE_HANDSHAKE:
+        raise ClientHelloError("not a handshake record: %d" % client_hello.content_type)
+    data = bf.read_until_n(client_hello.length)
+
+    # handshake header: type 1 bytes, length 3 bytes
+    while len(data) < 4 or len(data) < 4 + int.from_bytes(data[1: 4], "big"):
+        if len(data) > MAX_HANDSHAKE_LENGTH:
+            raise ClientHelloError("client hello too large")
+        content_type, _, length = RECORD_HEADER.unpack(bf.read_until_n(RECORD_HEADER.size))
+        if content_type != CONTENT_TYPE_HANDSHAKE:
+            raise ClientHelloError("not a handshake record: %d" % content_type)
+        if isinstance(data, bytes):
+            data = bytearray(data)
+        data += bf.read_until_n(length)
+
+    return memoryview(data)[: 4 + int.from_bytes(data[1: 4], "big")]
+
+
+def _parse_server_name(client_hello: ClientHello, data: memoryview):
+    # list length 2 bytes
+    pos, end = 2, len(data)
+    while pos + 3 <= end:
+        typ = data[pos]
+        n, = struct.unpack_from("!H", data, pos + 1)
+        pos += 3
+        if typ == 0x0:
+            client_hello.server_name = str(data[pos: pos + n], "utf-8")
+            return
+        pos += n
+
+
+def _parse_alpn(client_hello: ClientHello, data: memoryview):
+    # list length 2 bytes
+    pos, end = 2, len(data)
+    while pos < end:
+        n = data[pos]
+        client_hello.alpn.append(str(data[pos + 1: pos + 1 + n], "ascii"))
+        pos += 1 + n
+
+
+def _parse_supported_versions(client_hello: ClientHello, data: memoryview):
+    # list length 1 bytes
+    n = data[0] if len(data) > 0 else 0
+    client_hello.supported_versions = [v for v, in struct.iter_unpack("!H", data[1: 1 + n - n % 2])]
+
+
+_EXTENSION_PARSERS = {
+    EXT_SERVER_NAME: _parse_server_name,
+    EXT_ALPN: _parse_alpn,
+    EXT_SUPPORTED_VERSIONS: _parse_supported_versions,
+}
+
+
+def parse_client_hello(client_hello: ClientHello, data: memoryview):
+    """
+    在handshake消息上按偏移量解析一遍,不切分出新的bytes
+    """
+    end = len(data)
+    try:
+        client_hello.handshake_type = data[0]
+        if client_hello.handshake_type != HANDSHAKE_CLIENT_HELLO:
+            raise ClientHelloError("not a client hello: %d" % client_hello.handshake_type)
+        client_hello.handshake_length = int.from_bytes(data[1: 4], "big")
+        client_hello.handshake_version, = struct.unpack_from("!H", data, 4)
+        pos = 6
+
+        client_hello.random = bytes(data[pos: pos + 32])
+        pos += 32
+        client_hello.session_id_len = data[pos]
+        pos += 1
+        client_hello.session_id = bytes(data[pos: pos + client_hello.session_id_len])
+        pos += client_hello.session_id_len
+        client_hello.cipher_suites_len, = struct.unpack_from("!H", data, pos)
+        pos += 2
+        client_hello.cipher_suites = bytes(data[pos: pos + client_hello.cipher_suites_len])
+        pos += client_hello.cipher_suites_len
+        client_hello.compression_ml = data[pos]
+        pos += 1
+        client_hello.compression_methods = bytes(data[pos: pos + client_hello.compression_ml])
+        pos += client_hello.compression_ml
+        if pos > end:
+            raise ClientHelloError("client hello truncated")
+        # 没有扩展字段
+        if pos == end:
+            return
+
+        client_hello.extensions_len, = struct.unpack_from("!H", data, pos)
+        pos += 2
+        ext_end = min(pos + client_hello.extensions_len, end)
+        while pos + 4 <= ext_end:
+            e_type, e_length = struct.unpack_from("!HH", data, pos)
+            pos += 4
+            parser = _EXTENSION_PARSERS.get(e_type)
+            if parser is not None:
+                parser(client_hello, data[pos: min(pos + e_length, ext_end)])
+            pos += e_length
+    except (IndexError, struct.error, UnicodeDecodeError) as e:
+        raise ClientHelloError("invalid client hello: %s" % e)
+
 
 def read_client_hello(reader: Reader)->ClientHello:
     """
     读取clientHello
     """
-    # 先读header content-type 1 version 2 length 2
     client_hello = ClientHello()
-    header_len = 5
     bf = BufferReader(reader)
-    header_bytes = bf.read_until_n(header_len)
-    client_hello.content_type = header_bytes[0]
-    client_hello.version = bytes_to_int(header_bytes[1: 3])
-    client_hello.length = bytes_to_int(header_bytes[3: 5])
-
-    content = bf.read_until_n(client_hello.length)
-
-    consumer = Consumer(content)
-    client_hello.handshake_type = consumer.consume(1)
-    client_hello.handshake_length = consumer.consume(3)
-    client_hello.version = consumer.consume(2)
-
-    client_hello.random = consumer.consume(32)
-    client_hello.session_id_len = consumer.consume(1)
-    client_hello.session_id = consumer.consume(client_hello.session_id_len)
-    client_hello.cipher_suites_len = consumer.consume(2)
-    client_hello.cipher_suites = consumer.consume(client_hello.cipher_suites_len)
-    client_hello.compression_ml = consumer.consume(1)
-    client_hello.compression_methods = consumer.consume(client_hello.compression_ml)
-
-    def read_server_name(e_data: bytes):
-        e_data = e_data[2:]
-        while len(e_data) > 0:
-            typ = e_data[0]
-            e_data = e_data[1:]
-            d_l = bytes_to_int(e_data[: 2])
-            e_data = e_data[2:]
-            d = e_data[: d_l]
-            e_data = e_data[d_l:]
-            if typ == 0x0:
-                client_hello.server_name = d.decode("utf-8")
-
-    # extensions
-    while consumer.len() > 0:
-        e_type = consumer.consume(2)
-        e_length = consumer.consume(2)
-        e_datas = consumer.consume(e_length)
-        if e_type != 0x0000:
-            continue
-        read_server_name(e_datas)
-
+    try:
+        data = _read_handshake(bf, client_hello)
+    finally:
+        bf.release()
+    parse_client_hello(client_hello, data)
     return client_hello
 
 
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2019-09-07 15:02
+# @File    : upstream.py
+
+import time
+import socket
+import threading
+import collections
+from log import logger
+
+
+def is_alive(s: socket.socket)->bool:
+    """
+    检查空闲的连接是否还可用
+    对端已经关闭(读到EOF)或者空闲时收到了数据都认为不可用
+    """
+    try:
+        s.setblocking(False)
+        try:
+            s.recv(1, socket.MSG_PEEK)
+        finally:
+            s.setblocking(True)
+    except BlockingIOError:
+        # 没有数据可读,连接正常
+        return True
+    except OSError:
+        return False
+    return False
+
+
+class UpstreamPool:
+    def __init__(self, addr: (str, int), min_idle=0, max_idle=16, idle_timeout=60.0, connect_timeout=None):
+        """
+        一个后端地址的连接池
+        get返回的连接只使用一次: 转发结束后由handler关闭,不会放回连接池
+        put只用于确定没有被使用过的连接,例如maintain预热的连接
+        :param addr: 后端地址
+        :param min_idle: 预先建立并保持的空闲连接数
+        :param max_idle: 最多保存的空闲连接数,超过的直接关闭
+        :param idle_timeout: 空闲超过这个时间(秒)的连接会被关闭
+        :param connect_timeout: 建立连接的超时时间(秒)
+        """
+        self.addr = addr
+        self.min_idle = min_idle
+        self.max_idle = max(max_idle, min_idle)
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        # (socket, 开始空闲的时间), 右边是最近放入的
+        self._idle = collections.deque()
+        self._lock = threading.Lock()
+
+    def idle_count(self)->int:
+        return len(self._idle)
+
+    def _connect(self, connect_timeout=None)->socket.socket:
+        if connect_timeout is None:
+            connect_timeout = self.connect_timeout
+        s = socket.create_connection(self.addr, timeout=connect_timeout)
+        s.settimeout(None)
+        return s
+
+    def get(self, connect_timeout=None)->socket.socket:
+        """
+        优先使用最近放入的空闲连接,检查不可用则关闭继续取,没有空闲连接时新建
+        :param connect_timeout: 新建连接的超时(秒),None使用连接池的设置
+        """
+        now = time.monotonic()
+        while True:
+            with self._lock:
+                if len(self._idle) == 0:
+                    break
+                s, since = self._idle.pop()
+            if now - since < self.idle_timeout and is_alive(s):
+                return s
+            s.close()
+        return self._connect(connect_timeout)
+
+    def put(self, s: socket.socket):
+        """
+        归还可以复用的连接
+        """
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append((s, time.monotonic()))
+                return
+        s.close()
+
+    def maintain(self):
+        """
+        关闭超时和已经断开的空闲连接,并补足min_idle个空闲连接
+        """
+        now = time.monotonic()
+        with self._lock:
+            idle = list(self._idle)
+            self._idle.clear()
+
+        keep = []
+        for s, since in idle:
+            if now - since < self.idle_timeout and is_alive(s):
+                keep.append((s, since))
+            else:
+                s.close()
+
+        with self._lock:
+            # 维护期间放入的连接更新,放在右边
+            self._idle.extendleft(reversed(keep))
+            missing = self.min_idle - len(self._idle)
+
+        for _ in range(missing):
+            try:
+                s = self._connect()
+            except OSError as e:
+                logger.warning("warm up connection to %s:%d failed cause: %s", self.addr[0], self.addr[1], e)
+                break
+            self.put(s)
+
+    def close(self):
+        with self._lock:
+            idle = list(self._idle)
+            self._idle.clear()
+        for s, _ in idle:
+            s.close()
+
+
+class UpstreamPools:
+    def __init__(self, min_idle=0, max_idle=16, idle_timeout=60.0, connect_timeout=None, maintain_interval=1.0):
+        """
+        按后端地址区分的连接池集合,由一个后台线程统一维护
+        attach到BackendPool(VhostRouter/ConfigManager创建的BackendPool)时自动启动后台线程
+        预先建立的连接只能省掉建立连接的时间,每个连接只转发一个客户端连接
+        参数含义见UpstreamPool
+        :param maintain_interval: 后台维护的间隔(秒)
+        """
+        self.min_idle = min_idle
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.maintain_interval = maintain_interval
+        self._pools = dict()
+        # 使用连接池的对象(BackendPool) -> 后端地址
+        self._owners = dict()
+        # attach过的地址, 不再被任何owner使用时关闭
+        self._attached = set()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._maintainer = None
+
+    def pool(self, addr: (str, int))->UpstreamPool:
+        p = self._pools.get(addr)
+        if p is not None:
+            return p
+        with self._lock:
+            p = self._pools.get(addr)
+            if p is None:
+                p = UpstreamPool(addr, self.min_idle, self.max_idle, self.idle_timeout, self.connect_timeout)
+                self._pools[addr] = p
+        return p
+
+    def attach(self, owner, addrs: list):
+        """
+        owner(BackendPool)使用这些地址的连接池, 不再使用时调用detach
+        """
+        with self._lock:
+            self._owners[owner] = tuple(addrs)
+            self._attached.update(addrs)
+        for addr in addrs:
+            self.pool(addr)
+        self.start()
+
+    def detach(self, owner):
+        """
+        关闭attach过但已经没有owner使用的地址的连接池,之后不再维护和预热
+        直接get的地址不受影响
+        """
+        with self._lock:
+            self._owners.pop(owner, None)
+            used = set()
+            for addrs in self._owners.values():
+                used.update(addrs)
+            removed = [self._pools.pop(addr) for addr in self._attached - used if addr in self._pools]
+            self._attached &= used
+        for p in removed:
+            logger.info("upstream %s:%d no longer used, closing its pool", p.addr[0], p.addr[1])
+            p.close()
+
+    def get(self, addr: (str, int), connect_timeout=None)->socket.socket:
+        return self.pool(addr).get(connect_timeout)
+
+    def put(self, addr: (str, int), s: socket.socket):
+        """
+        只能放入没有被使用过的连接,见UpstreamPool
+        """
+        self.pool(addr).put(s)
+
+    def maintain(self):
+        for p in list(self._pools.values()):
+            p.maintain()
+
+    def _maintain_loop(self):
+        while True:
+            try:
+                self.maintain()
+            except Exception as e:
+                logger.error("maintain upstream pools failed cause: %s", e)
+            if self._stopped.wait(self.maintain_interval):
+                return
+
+    def start(self):
+        """
+        启动后台维护线程,在后台预热所有已知后端的连接, 重复调用没有影响
+        """
+        with self._lock:
+            if self._maintainer is not None or self._stopped.is_set():
+                return
+            self._maintainer = threading.Thread(target=self._maintain_loop)
+        self._maintainer.setDaemon(True)
+        self._maintainer.start()
+
+    def close(self):
+        self._stopped.set()
+        for p in list(self._pools.values()):
+            p.close()
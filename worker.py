@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2019-09-14 16:40
+# @File    : worker.py
+
+import os
+import time
+import queue
+import signal
+import threading
+import multiprocessing
+from log import logger
+from metrics import registry, Registry, StatsServer
+
+
+def _report_stats(proxy, worker_id: int, stats_queue, interval: float, with_metrics: bool):
+    while True:
+        time.sleep(interval)
+        metrics = registry.snapshot() if with_metrics else None
+        try:
+            stats_queue.put_nowait((worker_id, os.getpid(), proxy.stats(), metrics))
+        except queue.Full:
+            pass
+
+
+def _run_worker(make_proxy, worker_id: int, stats_queue, stats_interval: float, with_metrics: bool):
+    """
+    worker进程: 创建proxy并用SO_REUSEPORT监听,内核在各个worker之间分配连接
+    /metrics由master汇总之后提供,worker不监听stats_addr
+    """
+    # 由master负责退出
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # master转发的SIGHUP, 设置了ConfigManager的proxy启动时会重新设置
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    proxy = make_proxy()
+    proxy.reuse_port = True
+    if proxy.stats_addr is not None:
+        logger.warning("worker %d ignores stats_addr %s, set Master stats_addr instead", worker_id, proxy.stats_addr)
+        proxy.stats_addr = None
+    reporter = threading.Thread(target=_report_stats,
+                                args=(proxy, worker_id, stats_queue, stats_interval, with_metrics))
+    reporter.setDaemon(True)
+    reporter.start()
+    proxy.start()
+
+
+class _WorkerMetrics:
+    def __init__(self, master):
+        """
+        StatsServer使用的registry, 每次抓取时合并各个worker最近一次上报的指标
+        """
+        self._master = master
+
+    def render(self)->str:
+        merged = Registry()
+        for snapshot in list(self._master._metrics.values()):
+            merged.merge(snapshot)
+        return merged.render()
+
+
+class Master:
+    def __init__(self, make_proxy, workers: int = None, stats_interval: float = 5.0, restart_delay: float = 1.0,
+                 stats_addr: (str, int) = None):
+        """
+        预先fork多个worker进程,每个进程有自己的accept循环,突破GIL只能用一个核的限制
+        :param make_proxy: 在worker进程中调用,返回Proxy/CrackProxy/AsyncProxy等
+        :param workers: worker进程数,默认为cpu核数
+        :param stats_interval: worker上报统计的间隔(秒)
+        :param restart_delay: worker退出后重启前等待的时间(秒)
+        :param stats_addr: 设置了则由master在这个地址提供所有worker汇总的/metrics
+        """
+        self.make_proxy = make_proxy
+        self.workers = workers or os.cpu_count() or 1
+        self.stats_interval = stats_interval
+        self.restart_delay = restart_delay
+        self.stats_addr = stats_addr
+        self._ctx = multiprocessing.get_context("fork")
+        self._stats_queue = self._ctx.Queue(maxsize=self.workers * 16)
+        self._processes = dict()
+        # worker_id -> (pid, stats)
+        self._stats = dict()
+        # worker_id -> registry.snapshot()
+        self._metrics = dict()
+        self._stopped = False
+
+    def _spawn(self, worker_id: int):
+        p = self._ctx.Process(target=_run_worker,
+                              args=(self.make_proxy, worker_id, self._stats_queue, self.stats_interval,
+                                    self.stats_addr is not None))
+        p.daemon = True
+        p.start()
+        self._processes[worker_id] = p
+        logger.info("worker %d started with pid %d", worker_id, p.pid)
+
+    def _collect_stats(self, timeout: float):
+        try:
+            item = self._stats_queue.get(timeout=timeout)
+            while True:
+                worker_id, pid, stats, metrics = item
+                self._stats[worker_id] = (pid, stats)
+                if metrics is not None:
+                    self._metrics[worker_id] = metrics
+                item = self._stats_queue.get_nowait()
+        except queue.Empty:
+            return
+
+    def stats(self)->dict:
+        """
+        所有worker最近一次上报的统计之和
+        """
+        total = {"workers": sum(1 for p in self._processes.values() if p.is_alive())}
+        for _, stats in self._stats.values():
+            for k, v in stats.items():
+                if isinstance(v, (int, float)):
+                    total[k] = total.get(k, 0) + v
+        return total
+
+    def _check_workers(self):
+        for worker_id, p in list(self._processes.items()):
+            if p.is_alive():
+                continue
+            logger.warning("worker %d(pid %d) exited with %s, restarting", worker_id, p.pid, p.exitcode)
+            self._stats.pop(worker_id, None)
+            self._metrics.pop(worker_id, None)
+            time.sleep(self.restart_delay)
+            if not self._stopped:
+                self._spawn(worker_id)
+
+    def stop(self, *_):
+        self._stopped = True
+
+    def reload(self, *_):
+        """
+        SIGHUP转发给所有worker, 由worker中的ConfigManager重新加载配置
+        """
+        for p in self._processes.values():
+            if p.is_alive():
+                os.kill(p.pid, signal.SIGHUP)
+
+    def start(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP, self.reload)
+        for worker_id in range(self.workers):
+            self._spawn(worker_id)
+        stats_server = None
+        if self.stats_addr is not None:
+            # worker fork之后再启动线程
+            stats_server = StatsServer(self.stats_addr[0], self.stats_addr[1], _WorkerMetrics(self))
+            stats_server.start()
+
+        last_print = time.monotonic()
+        try:
+            while not self._stopped:
+                self._collect_stats(timeout=0.5)
+                self._check_workers()
+                if time.monotonic() - last_print >= self.stats_interval:
+                    last_print = time.monotonic()
+                    logger.info("stats: %s", self.stats())
+        finally:
+            if stats_server is not None:
+                stats_server.close()
+            for p in self._processes.values():
+                p.terminate()
+            for p in self._processes.values():
+                p.join()